@@ -0,0 +1,184 @@
+from sqlalchemy import delete, Column, Integer, String
+import argparse
+import os
+import sys
+import time
+from log import Base, default_db_path, open_db
+
+try:
+    import numpy
+except ImportError:
+    raise SystemExit('The audit needs numpy, install it with pip install numpy')
+
+PROBLEMS = ('unreadable_date', 'death_before_birth', 'burial_before_death', 'age_mismatch', 'stillborn_with_age')
+
+DATES = ('date_of_birth', 'date_of_death', 'date_of_burial')
+
+AGES = ('age_years', 'age_months', 'age_days')
+
+# What the last audit found, replaced by every run. It is not part of the
+# schema log.py checks so databases that have never been audited are unchanged
+class AuditFinding(Base):
+    __tablename__ = 'audit_report'
+    id = Column(Integer, primary_key = True)
+    burial_id = Column(Integer, nullable = False)
+    source_document_ref = Column(Integer)
+    problem = Column(String(32), nullable = False)
+    detail = Column(String(256))
+
+COLUMNS = ('id', 'source_document_ref') + DATES + AGES + ('stillborn',)
+
+# The columns the checks need, a chunk at a time as one array per column.
+# The rows are read straight from the DB-API cursor, making a SQLAlchemy row
+# for each would take longer than all the checks together
+def read_chunks(sql_session, chunk_size):
+    cursor = sql_session.connection().connection.cursor()
+    cursor.execute('select ' + ', '.join(COLUMNS) + ' from burial order by id')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        columns = dict(zip(COLUMNS, zip(*rows)))
+        chunk = {'id': numpy.array(columns['id'], dtype = numpy.int64),
+                 'source_document_ref': numpy.array(columns['source_document_ref'], dtype = object)}
+        for name in DATES:
+            chunk[name] = columns[name]
+        # Missing numbers become NaN so they drop out of every comparison
+        for name in AGES + ('stillborn',):
+            chunk[name] = numpy.array(columns[name], dtype = numpy.float64)
+        yield chunk
+    cursor.close()
+
+# Parse a column of date strings, missing ones become NaT. The whole column is
+# parsed at once and only when that fails is each value tried to find the bad ones
+def parse_dates(values, unreadable):
+    try:
+        return numpy.array(values, dtype = 'datetime64[D]')
+    except ValueError:
+        pass
+    dates = numpy.empty(len(values), dtype = 'datetime64[D]')
+    for n, value in enumerate(values):
+        try:
+            dates[n] = numpy.datetime64(value, 'D') if value else numpy.datetime64('NaT')
+        except ValueError:
+            dates[n] = numpy.datetime64('NaT')
+            unreadable.append(n)
+
+    return dates
+
+# Completed years between two arrays of dates
+def whole_years(born, died):
+    years = died.astype('datetime64[Y]').astype(numpy.int64) - born.astype('datetime64[Y]').astype(numpy.int64)
+    def month_day(dates):
+        months = dates.astype('datetime64[M]')
+        return (months.astype(numpy.int64) % 12) * 32 + (dates - months).astype(numpy.int64)
+
+    return years - (month_day(died) < month_day(born))
+
+# Numbers as they read on the card, - where there is none
+def as_text(numbers):
+    return numpy.where(numpy.isnan(numbers), '-', numpy.nan_to_num(numbers).astype(numpy.int64).astype(str))
+
+# Check one chunk, returning its findings as (burial_id, source_document_ref, problem, detail) rows
+def audit_chunk(chunk, burial_tolerance, age_tolerance, infant_tolerance):
+    findings = []
+    # The detail is made by joining parts, each either text or an array with a value for every row
+    def found(problem, mask, *parts):
+        rows = numpy.flatnonzero(mask)
+        if len(rows) == 0:
+            return
+        texts = []
+        for part in parts:
+            if isinstance(part, str):
+                texts.append([part] * len(rows))
+            elif part.dtype == numpy.float64:
+                texts.append(as_text(part[rows]).tolist())
+            else:
+                texts.append(part[rows].astype(str).tolist())
+        findings.extend(zip(chunk['id'][rows].tolist(), chunk['source_document_ref'][rows].tolist(),
+                            [problem] * len(rows), [''.join(text) for text in zip(*texts)]))
+
+    dates = {}
+    for name in DATES:
+        unreadable = []
+        dates[name] = parse_dates(chunk[name], unreadable)
+        if unreadable:
+            found('unreadable_date', numpy.isin(numpy.arange(len(chunk['id'])), unreadable),
+                  name + ' is ', numpy.array(chunk[name], dtype = object))
+    born = dates['date_of_birth']
+    died = dates['date_of_death']
+    buried = dates['date_of_burial']
+
+    # NaT compares false with everything so missing dates are never flagged
+    found('death_before_birth', died < born, 'died ', died, ', born ', born)
+    found('burial_before_death', buried < died - numpy.timedelta64(burial_tolerance, 'D'), 'buried ', buried, ', died ', died)
+
+    known = ~numpy.isnat(born) & ~numpy.isnat(died)
+    years = numpy.where(known, whole_years(born, died), 0)
+    found('age_mismatch', known & (numpy.abs(chunk['age_years'] - years) > age_tolerance),
+          'age ', chunk['age_years'], ' years, the dates give ', years)
+
+    # Infants are usually given an age in months and days only
+    days = numpy.where(known, (died - born).astype(numpy.int64), 0)
+    infant = numpy.isnan(chunk['age_years']) & ~(numpy.isnan(chunk['age_months']) & numpy.isnan(chunk['age_days']))
+    given_days = numpy.nan_to_num(chunk['age_months']) * 30.44 + numpy.nan_to_num(chunk['age_days'])
+    found('age_mismatch', known & infant & (numpy.abs(given_days - days) > infant_tolerance),
+          'age ', chunk['age_months'], ' months ', chunk['age_days'], ' days, the dates give ', days, ' days')
+
+    any_age = ~(numpy.isnan(chunk['age_years']) & numpy.isnan(chunk['age_months']) & numpy.isnan(chunk['age_days']))
+    found('stillborn_with_age', (chunk['stillborn'] > 0) & any_age,
+          'stillborn, age ', chunk['age_years'], ' years ', chunk['age_months'], ' months ', chunk['age_days'], ' days')
+
+    return findings
+
+# Audit the whole burial table, replacing the report table with what is found.
+# Returns the number of cards checked, the findings by problem and the time taken
+def audit_cards(sql_session, chunk_size = 100000, burial_tolerance = 1, age_tolerance = 1, infant_tolerance = 31, progress = None):
+    rows = 0
+    counts = {problem: 0 for problem in PROBLEMS}
+    started = time.perf_counter()
+    with sql_session.begin():
+        AuditFinding.__table__.create(sql_session.connection(), checkfirst = True)
+        sql_session.execute(delete(AuditFinding))
+        for chunk in read_chunks(sql_session, chunk_size):
+            rows += len(chunk['id'])
+            findings = audit_chunk(chunk, burial_tolerance, age_tolerance, infant_tolerance)
+            if findings:
+                sql_session.connection().exec_driver_sql('insert into audit_report (burial_id, source_document_ref, problem, detail) '
+                                                         'values (?, ?, ?, ?)', findings)
+                for finding in findings:
+                    counts[finding[2]] += 1
+            if progress:
+                progress(rows, time.perf_counter() - started)
+
+    return rows, counts, time.perf_counter() - started
+
+def print_progress(rows, elapsed):
+    print('%d rows checked, %.0f rows/s' % (rows, rows / elapsed if elapsed > 0 else 0.0), file = sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Check the dates and ages of every card against each other')
+    parser.add_argument('--db', default = default_db_path(), help = 'database to audit (default: %(default)s)')
+    parser.add_argument('--chunk-size', type = int, default = 100000, help = 'rows checked at a time (default: %(default)s)')
+    parser.add_argument('--burial-days', type = int, default = 1,
+                        help = 'days a burial may be dated before the death before it is reported (default: %(default)s)')
+    parser.add_argument('--age-years', type = int, default = 1,
+                        help = 'years an age may differ from the dates before it is reported (default: %(default)s)')
+    parser.add_argument('--infant-days', type = int, default = 31,
+                        help = 'days an age in months and days may differ from the dates (default: %(default)s)')
+    parser.add_argument('--quiet', action = 'store_true', help = 'only report the totals')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        sys.exit('There is no database at ' + args.db)
+
+    sql_engine, sql_session = open_db(args.db)
+
+    rows, counts, elapsed = audit_cards(sql_session, args.chunk_size, args.burial_days, args.age_years, args.infant_days,
+                                        None if args.quiet else print_progress)
+
+    for problem in PROBLEMS:
+        print('%-20s %d' % (problem, counts[problem]))
+    print('Checked %d cards in %.2fs, %d findings are in the audit_report table' % (rows, elapsed, sum(counts.values())))
+
+    sql_session.close()
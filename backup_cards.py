@@ -0,0 +1,130 @@
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+from log import JOURNAL_COLUMNS, Config, Snapshotter, default_db_path, open_db
+
+# When the change with seq was made according to the journal in the backup, or None
+def changed_at(journal, seq):
+    row = journal.execute('select changed_at from burial_journal where seq = ?', (seq,)).fetchone()
+
+    return row[0] if row else None
+
+# A full copy made after journal rows were trimmed with backups off has no
+# journal row of its own, so the time the file was written is used for it
+def made_at(path):
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+
+# Rebuild the database as it was at until, a 'YYYY-MM-DD HH:MM:SS.fff' local time,
+# into output from the newest full copy made before then and the journal after it.
+# Returns the seq of the copy used and the number of changes replayed on top of it
+def restore(directory, output, until):
+    journal_path = os.path.join(directory, 'journal.db')
+    if not os.path.exists(journal_path):
+        raise RuntimeError('There is no journal in ' + directory)
+    journal = sqlite3.connect(journal_path)
+    try:
+        # Local times go back when the clocks do, so until is turned into the last change made by
+        # then and everything up to it is replayed. Filtering on the time could skip changes in
+        # between and give a state the database was never in
+        cutoff = journal.execute('select max(seq) from burial_journal where changed_at <= ?', (until,)).fetchone()[0] or 0
+        bases = [(seq, path) for seq, path in Snapshotter.bases(directory)
+                 if seq == 0 or seq <= cutoff or changed_at(journal, seq) is None and made_at(path) <= until]
+    finally:
+        journal.close()
+    if not bases:
+        raise RuntimeError('There is no backup in ' + directory + ' from before ' + until)
+    seq, base_path = bases[-1]
+
+    base = sqlite3.connect(base_path)
+    target = sqlite3.connect(output, isolation_level = None)
+    try:
+        base.backup(target)
+        target.execute('attach database ? as backup', (journal_path,))
+        target.execute('begin')
+        changes = target.execute('select change, burial_id, ' + ', '.join(JOURNAL_COLUMNS) + ' from backup.burial_journal '
+                                 'where seq > ? and seq <= ? order by seq', (seq, cutoff)).fetchall()
+        # Replayed as the same statements so burial's own triggers, the name search index's
+        # included, keep everything else in step. insert or replace would skip its delete trigger
+        for change in changes:
+            if change[0] == 'delete':
+                target.execute('delete from burial where id = ?', (change[1],))
+            elif change[0] == 'insert':
+                target.execute('insert into burial (id, ' + ', '.join(JOURNAL_COLUMNS) + ') values (' +
+                               ', '.join('?' * (len(JOURNAL_COLUMNS) + 1)) + ')', change[1:])
+            else:
+                target.execute('update burial set ' + ', '.join(name + ' = ?' for name in JOURNAL_COLUMNS) + ' where id = ?',
+                               change[2:] + change[1:2])
+        # The triggers journalled the replay as new changes, put back the ones it replayed
+        target.execute('delete from main.burial_journal where seq > ?', (seq,))
+        target.execute('insert into main.burial_journal select * from backup.burial_journal where seq > ? and seq <= ?', (seq, cutoff))
+        target.execute('commit')
+        target.execute('detach database backup')
+    finally:
+        base.close()
+        target.close()
+
+    return seq, len(changes)
+
+def list_backups(directory):
+    journal_path = os.path.join(directory, 'journal.db')
+    journal = sqlite3.connect(journal_path) if os.path.exists(journal_path) else None
+    try:
+        for seq, path in Snapshotter.bases(directory):
+            print('%-20s full copy up to change %d, made %s' %
+                  (os.path.basename(path), seq, (journal and changed_at(journal, seq)) or 'before the journal began'))
+        if journal is not None:
+            count, first, last = journal.execute('select count(*), min(changed_at), max(changed_at) from burial_journal').fetchone()
+            print('%-20s %d changes from %s to %s' % ('journal.db', count, first, last))
+    finally:
+        if journal is not None:
+            journal.close()
+
+def parse_time(text):
+    try:
+        return datetime.datetime.fromisoformat(text).strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a local time like 2024-05-01 17:30')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Back the card database up, or restore it as it was at a point in time')
+    parser.add_argument('--db', default = default_db_path(), help = 'database to back up (default: %(default)s)')
+    parser.add_argument('--dir', help = 'backup directory (default: Backup/Directory in the config table, or next to the database)')
+    parser.add_argument('--full', action = 'store_true', help = 'make a new full copy rather than only copying the changes')
+    parser.add_argument('--list', action = 'store_true', help = 'list the backups instead of making one')
+    parser.add_argument('--restore', type = parse_time, metavar = 'TIME', help = 'restore the cards as they were at this local time')
+    parser.add_argument('--output', help = 'new database to restore into, required with --restore')
+    args = parser.parse_args()
+
+    directory = args.dir
+    if os.path.exists(args.db):
+        # Opening the database migrates it, so it has the journal before it is copied
+        sql_engine, sql_session = open_db(args.db)
+        directory = directory or Config.get_value(sql_session, 'Backup', 'Directory')
+        sql_session.close()
+    directory = directory or Snapshotter.default_directory(args.db)
+
+    if args.list:
+        list_backups(directory)
+    elif args.restore:
+        if not args.output:
+            sys.exit('Give the new database to restore into with --output')
+        if os.path.exists(args.output):
+            sys.exit(args.output + ' already exists, restore into a new file')
+        try:
+            seq, replayed = restore(directory, args.output, args.restore)
+        except (RuntimeError, sqlite3.Error) as e:
+            sys.exit(str(e))
+        print('Restored %s from the full copy up to change %d and %d changes after it' % (args.output, seq, replayed))
+        print('Back it up to a new directory if it replaces %s, the backups in %s go on past %s' % (args.db, directory, args.restore))
+    else:
+        if not os.path.exists(args.db):
+            sys.exit('There is no database at ' + args.db)
+        try:
+            base, copied = Snapshotter.snapshot(args.db, directory, args.full)
+        except (OSError, RuntimeError, sqlite3.Error) as e:
+            sys.exit(str(e))
+        if base is not None:
+            print('Made a full copy of %s up to change %d in %s' % (args.db, base, directory))
+        print('Copied %d changes to %s' % (copied, os.path.join(directory, 'journal.db')))
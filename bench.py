@@ -0,0 +1,247 @@
+from sqlalchemy import delete, func, select
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import log
+from log import Burial, BurialBrowser, BurialStats, Completer, Config, DuplicateFinder, GraveIndex, VERSION, open_db
+
+# Synthetic databases are kept here between runs as the large ones take a while to build
+DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'bench_data')
+
+SIZES = (10000, 100000, 1000000)
+
+GIVEN_NAMES = ('John', 'William', 'Mary', 'Elizabeth', 'Thomas', 'James', 'Ann', 'Sarah', 'George', 'Jane',
+               'Henry', 'Margaret', 'Charles', 'Emily', 'Joseph', 'Alice', 'Robert', 'Ellen', 'Edward', 'Hannah',
+               'Frederick', 'Martha', 'Arthur', 'Florence', 'Albert', 'Edith', 'Samuel', 'Harriet', 'Richard', 'Ada')
+
+FAMILY_NAMES = ('Smith', 'Jones', 'Williams', 'Taylor', 'Brown', 'Davies', 'Evans', 'Wilson', 'Thomas', 'Johnson',
+                'Roberts', 'Robinson', 'Thompson', 'Wright', 'Walker', 'White', 'Edwards', 'Hughes', 'Green', 'Hall',
+                'Lewis', 'Harris', 'Clarke', 'Patel', 'Jackson', 'Wood', 'Turner', 'Martin', 'Cooper', 'Hill')
+
+# Weights falling off as 1/rank so a few names and plots dominate, as they do in a real parish
+def zipf_weights(count, exponent = 1.1):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+def synthetic_cards(count, seed = 1):
+    rng = random.Random(seed)
+    family_names = list(FAMILY_NAMES) + ['Family%04d' % n for n in range(3000)]
+    family_weights = zipf_weights(len(family_names))
+    given_weights = zipf_weights(len(GIVEN_NAMES), 0.8)
+    plots = ['%s%d' % (section, n) for section in 'ABCDEFGHJK' for n in range(1, 21)]
+    plot_weights = zipf_weights(len(plots), 0.7)
+    for ref in range(1, count + 1):
+        born = rng.randint(1820, 1990)
+        stillborn = rng.random() < 0.005
+        age = 0 if stillborn else min(int(rng.expovariate(1 / 55)), 105)
+        died = min(born + age, 2020)
+        card = {'given_names': ' '.join(rng.choices(GIVEN_NAMES, given_weights, k = rng.choice((1, 1, 2)))),
+                'family_name': rng.choices(family_names, family_weights)[0],
+                'date_of_birth': '%04d-%02d-%02d' % (born, rng.randint(1, 12), rng.randint(1, 28)) if rng.random() < 0.6 else None,
+                'date_of_death': '%04d-%02d-%02d' % (died, rng.randint(1, 12), rng.randint(1, 28)),
+                'date_of_burial': '%04d-%02d-%02d' % (died, rng.randint(1, 12), rng.randint(1, 28)) if rng.random() < 0.8 else None,
+                'ashes': rng.random() < 0.1,
+                'age_years': None if stillborn else age,
+                'age_months': None,
+                'age_days': None,
+                'stillborn': stillborn,
+                'source_document_ref': ref,
+                'cross_reference': None,
+                'page_number': ref // 20 + 1,
+                'see_page_number': None,
+                'plot': rng.choices(plots, plot_weights)[0],
+                'plot_row': str(rng.randint(1, 40)),
+                'plot_row_number': str(rng.randint(1, 60)),
+                'notes': None,
+                'confidence_level': rng.choice((3, 3, 3, 2, 1))}
+        yield card
+
+# Build (or reuse) a database of count synthetic cards with the schema create_db makes
+def synthetic_db(count, data_dir = DATA_DIR):
+    os.makedirs(data_dir, exist_ok = True)
+    db_path = os.path.join(data_dir, 'cards_%d.db' % count)
+    if os.path.exists(db_path):
+        return db_path
+
+    building = db_path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+    sql_engine, sql_session = open_db(building)
+    Config.add_value(sql_session, 'Source', 'DocumentName', 'Synthetic %d' % count)
+    batch = []
+    for card in synthetic_cards(count):
+        batch.append(card)
+        if len(batch) == 10000:
+            with sql_session.begin():
+                sql_session.execute(Burial.__table__.insert(), batch)
+            batch = []
+    if batch:
+        with sql_session.begin():
+            sql_session.execute(Burial.__table__.insert(), batch)
+    with sql_session.begin():
+        sql_session.execute('analyze')
+    sql_session.close()
+    sql_engine.dispose()
+    Config.invalidate()
+    os.rename(building, db_path)
+
+    return db_path
+
+def summary(times):
+    times = sorted(times)
+    return {'runs': len(times),
+            'mean_ms': statistics.mean(times) * 1000,
+            'median_ms': statistics.median(times) * 1000,
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+            'min_ms': times[0] * 1000}
+
+def measure(fn, repeat, setup = None):
+    times = []
+    for n in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+
+    return summary(times)
+
+# Time opening the database in a new interpreter, as when the log is launched.
+# This covers importing log and open_db, everything before the GUI is loaded
+def measure_startup(db_path, repeat):
+    code = ('import json, log; sql_engine, sql_session = log.open_db(%r); '
+            'log.StartupTimer.mark("open_db"); print(json.dumps(log.StartupTimer.report()))' % db_path)
+    times = []
+    for n in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], check = True, capture_output = True, text = True,
+                                cwd = os.path.abspath(os.path.dirname(__file__))).stdout
+        times.append(time.perf_counter() - started)
+    result = summary(times)
+    result['stages_ms'] = {stage: seconds * 1000 for stage, seconds in json.loads(output)['stages'].items()}
+
+    return result
+
+def bench_db(db_path, repeat):
+    results = {'startup': measure_startup(db_path, max(3, repeat // 20))}
+
+    sql_engine, sql_session = open_db(db_path)
+    log.sql_session = sql_session
+    BurialStats.load(sql_session)
+
+    with sql_session.begin():
+        last_id = sql_session.execute(select(func.max(Burial.id))).scalar()
+        last_ref = sql_session.execute(select(func.max(Burial.source_document_ref))).scalar() or 0
+
+    results['refresh_aggregates'] = measure(lambda: BurialStats.query(sql_session), repeat)
+    results['get_last_plot'] = measure(lambda: Burial.get_last_plot(sql_session), repeat)
+    results['config_get_value_cold'] = measure(lambda: Config.get_value(sql_session, 'Source', 'DocumentName'), repeat,
+                                               setup = lambda: Config.invalidate(sql_session))
+    results['config_get_value'] = measure(lambda: Config.get_value(sql_session, 'Source', 'DocumentName'), repeat)
+
+    cards = iter(synthetic_cards(repeat, seed = 2))
+    indexed = DuplicateFinder.has_index(sql_session)
+    results['duplicate_lookup'] = measure(lambda: DuplicateFinder.find(sql_session, next(cards), indexed), repeat)
+
+    # The occupancy index is built once per start, on a background thread in the form
+    results['grave_index_build'] = measure(lambda: GraveIndex.build(sql_engine), 1)
+    graves = iter([(card['plot'], card['plot_row'], card['plot_row_number']) for card in synthetic_cards(repeat, seed = 3)])
+    results['grave_lookup'] = measure(lambda: GraveIndex.occupants(*next(graves)), repeat)
+
+    # Completion tries are built once per start on a background thread, lookups happen on every key
+    results['completion_build'] = measure(lambda: Completer.build(sql_engine), 1)
+    prefixes = iter([card['family_name'][:2] for card in synthetic_cards(repeat, seed = 4)])
+    results['completion_lookup'] = measure(lambda: Completer.complete('family_name', next(prefixes)), repeat)
+
+    # Paging the review window forward by name from wherever the last page ended
+    page = [BurialBrowser.page(sql_session, 'Name')]
+    def next_page():
+        page[0] = BurialBrowser.page(sql_session, 'Name', after = BurialBrowser.key('Name', page[0][-1])) or BurialBrowser.page(sql_session, 'Name')
+    results['browse_next_page'] = measure(next_page, repeat)
+    results['browse_plot_filter'] = measure(lambda: BurialBrowser.page(sql_session, 'Plot', 'A1', last = True), repeat)
+
+    # Saves go through the same path as the Save button, the rows are removed afterwards
+    refs = iter(range(last_ref + 1, last_ref + repeat + 1))
+    values = {'-given_names-': 'Bench', '-family_name-': 'Mark', '-date_of_birth-': '1900-01-01',
+              '-date_of_death-': '1980-06-01', '-date_of_burial-': '1980-06-08', '-ashes-': False,
+              '-age_years-': '80', '-age_months-': '', '-age_days-': '', '-stillborn-': False,
+              '-cross_reference-': '', '-page_number-': '12', '-see_page_number-': '', '-plot-': 'A1',
+              '-plot_row-': '3', '-plot_row_number-': '7', '-notes-': '', '-confidence_level-': 'High'}
+    try:
+        results['save'] = measure(lambda: Burial.save_record(sql_session, Burial.values_to_record(
+                                      dict(values, **{'-source_document_ref-': str(next(refs))}))), repeat)
+    finally:
+        with sql_session.begin():
+            sql_session.execute(delete(Burial).where(Burial.id > (last_id or 0)))
+
+    sql_session.close()
+    sql_engine.dispose()
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True,
+                              cwd = os.path.abspath(os.path.dirname(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print each benchmark's median against a previous run, returning the ones
+# slower by more than threshold
+def compare(baseline, current, threshold):
+    regressions = []
+    for size, results in current['results'].items():
+        for name, result in results.items():
+            before = baseline['results'].get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] > 0 else 1.0
+            flag = ''
+            if ratio > 1 + threshold:
+                regressions.append((size, name, ratio))
+                flag = '  REGRESSION'
+            print('%8s %-24s %10.3fms %10.3fms %6.2fx%s' % (size, name, before['median_ms'], result['median_ms'], ratio, flag))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time the entry and query hot paths against synthetic databases')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = SIZES, help = 'numbers of cards to test with (default: %(default)s)')
+    parser.add_argument('--repeat', type = int, default = 200, help = 'runs of each benchmark (default: %(default)s)')
+    parser.add_argument('--data-dir', default = DATA_DIR, help = 'where the synthetic databases are kept (default: %(default)s)')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--compare', metavar = 'FILE', help = 'compare with the results of an earlier run')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'fractional slow down reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    report = {'version': VERSION,
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'repeat': args.repeat,
+              'results': {}}
+    for size in args.sizes:
+        print('Building %d card database' % size, file = sys.stderr)
+        db_path = synthetic_db(size, args.data_dir)
+        print('Timing %d cards' % size, file = sys.stderr)
+        report['results'][str(size)] = bench_db(db_path, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            sys.exit('%d benchmarks are more than %d%% slower' % (len(regressions), args.threshold * 100))
+    elif not args.output:
+        print(json.dumps(report, indent = 2))
@@ -0,0 +1,228 @@
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import argparse
+import json
+import socket
+import socketserver
+import sys
+import threading
+from log import (FIELDS, STORAGE_PROFILES, Burial, BurialStats, BurialWriter, Completer, Config, DuplicateFinder, EntryClient,
+                 GraveIndex, Snapshotter, default_db_path, get_source_document, open_db, trim_journal)
+
+# One process owns the database and everyone entering cards connects to it
+# with log.py --server. Saves from all of them go through one BurialWriter so
+# cards arriving together are committed together, source document refs are
+# handed out here so no two people are given the same one, and after each
+# commit the new counts and defaults are pushed to every connection.
+class EntryServer:
+    lock = threading.Lock()
+    sql_engine = None
+    source_document = None
+    indexed = False
+    version = 0
+    next_ref = 1
+    free_refs = set()
+    connections = set()
+    server = None
+    thread = None
+
+    # Serve the database open on sql_engine at host:port, port 0 picks a free
+    # one. Returns the address being served
+    def start(sql_engine, sql_session, host = '127.0.0.1', port = EntryClient.DEFAULT_PORT):
+        EntryServer.sql_engine = sql_engine
+        EntryServer.source_document = get_source_document(sql_session)
+        EntryServer.indexed = DuplicateFinder.has_index(sql_session)
+        BurialStats.load(sql_session)
+        Burial.set_default_plot(Burial.get_last_plot(sql_session))
+        EntryServer.next_ref = int(BurialStats.source_document_ref or 0) + 1
+        EntryServer.free_refs = set()
+        EntryServer.version = 0
+        BurialWriter.start(sql_engine)
+        GraveIndex.start(sql_engine, capacity = Config.get_int(sql_session, 'Graves', 'Capacity', GraveIndex.capacity))
+        Completer.start(sql_engine, Config.get_int(sql_session, 'Completion', 'Capacity', Completer.capacity))
+
+        EntryServer.server = socketserver.ThreadingTCPServer((host, port), EntryHandler, bind_and_activate = False)
+        EntryServer.server.allow_reuse_address = True
+        EntryServer.server.daemon_threads = True
+        EntryServer.server.server_bind()
+        EntryServer.server.server_activate()
+        EntryServer.thread = threading.Thread(target = EntryServer.server.serve_forever, name = 'EntryServer', daemon = True)
+        EntryServer.thread.start()
+
+        return EntryServer.server.server_address
+
+    # Stop taking connections and commit everything already sent
+    def stop():
+        if EntryServer.server is not None:
+            EntryServer.server.shutdown()
+            EntryServer.server.server_close()
+            EntryServer.thread.join()
+            EntryServer.server = None
+            for connection in list(EntryServer.connections):
+                connection.close()
+            BurialWriter.stop()
+
+    # The counts and defaults a form needs, version lets clients ignore stale copies
+    def state():
+        return {'version': EntryServer.version,
+                'row_count': BurialStats.row_count,
+                'date_of_birth': BurialStats.date_of_birth,
+                'date_of_death': BurialStats.date_of_death,
+                'date_of_burial': BurialStats.date_of_burial,
+                'source_document_ref': BurialStats.source_document_ref,
+                'page_number': BurialStats.page_number,
+                'default_plot': Burial.default_plot,
+                'capacity': GraveIndex.capacity}
+
+    # Hand a connection the lowest ref given back by someone else, or the next new one.
+    # Any ref it was holding and did not use is given back first
+    def reserve(connection):
+        with EntryServer.lock:
+            EntryServer.release_locked(connection)
+            if EntryServer.free_refs:
+                ref = min(EntryServer.free_refs)
+                EntryServer.free_refs.discard(ref)
+            else:
+                ref = EntryServer.next_ref
+                EntryServer.next_ref += 1
+            connection.reserved = ref
+
+        return ref
+
+    def release_locked(connection):
+        if connection.reserved is not None:
+            EntryServer.free_refs.add(connection.reserved)
+            connection.reserved = None
+
+    # Called from the writer thread once a card is committed
+    def saved(connection, record):
+        with EntryServer.lock:
+            BurialStats.update(record)
+            if record['plot']:
+                Burial.default_plot = record['plot']
+            ref = BurialStats.as_number(record['source_document_ref'])
+            if ref is not None:
+                if ref == connection.reserved:
+                    connection.reserved = None
+                EntryServer.free_refs.discard(ref)
+                EntryServer.next_ref = max(EntryServer.next_ref, int(ref) + 1)
+            EntryServer.version += 1
+            state = EntryServer.state()
+            connections = list(EntryServer.connections)
+
+        return state, connections
+
+    def broadcast(state, connections, skip = None):
+        for connection in connections:
+            if connection is not skip:
+                connection.send({'state': state})
+
+class EntryHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.reserved = None
+        self.sql_session = Session(EntryServer.sql_engine, expire_on_commit = False)
+        with EntryServer.lock:
+            EntryServer.connections.add(self)
+
+    def finish(self):
+        with EntryServer.lock:
+            EntryServer.connections.discard(self)
+            EntryServer.release_locked(self)
+        self.sql_session.close()
+        super().finish()
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Replies come from this connection's thread and the writer thread, pushes from any
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        except (OSError, ValueError):
+            # The client has gone, finish() tidies up after it. Writing to the file it
+            # has already closed raises ValueError
+            pass
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                break
+            op = message.get('op')
+            reply = {'id': message.get('id')}
+            try:
+                if op == 'hello':
+                    reply['source_document'] = EntryServer.source_document
+                    with EntryServer.lock:
+                        reply['state'] = EntryServer.state()
+                elif op == 'reserve':
+                    reply['ref'] = EntryServer.reserve(self)
+                elif op == 'save':
+                    # The reply is sent once the writer has committed or rejected the card
+                    self.save(message.get('id'), {field.name: message['record'].get(field.name) for field in FIELDS})
+                    continue
+                elif op == 'duplicates':
+                    reply['found'] = DuplicateFinder.lookup(self.sql_session, message['card'], EntryServer.indexed)
+                elif op == 'grave':
+                    reply['grave'] = Burial.describe_grave(self.sql_session, message['plot'], message['plot_row'], message['plot_row_number'])
+                elif op == 'complete':
+                    reply['completion'] = Completer.complete(message['name'], message['prefix'])
+                else:
+                    reply['error'] = 'Unknown request ' + repr(op)
+            except Exception as e:
+                reply['error'] = str(e)
+            self.send(reply)
+
+    def save(self, message_id, record):
+        BurialWriter.put(record, lambda id, e: self.on_saved(message_id, record, id, e))
+
+    def on_saved(self, message_id, record, id, e):
+        if e is not None:
+            self.send({'id': message_id, 'error': str(getattr(e, 'orig', e)), 'integrity': isinstance(e, IntegrityError)})
+            return
+        state, connections = EntryServer.saved(self, record)
+        self.send({'id': message_id, 'saved': id, 'state': state})
+        EntryServer.broadcast(state, connections, skip = self)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Own the card database and take cards from several copies of log.py --server')
+    parser.add_argument('--db', default = default_db_path(), help = 'database to enter cards into (default: %(default)s)')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type = int, default = EntryClient.DEFAULT_PORT, help = 'port to listen on (default: %(default)s)')
+    parser.add_argument('--storage-profile', choices = sorted(STORAGE_PROFILES), default = 'default',
+                        help = 'SQLite settings to use, the wal profiles need the database on a local drive')
+    parser.add_argument('--source-document', help = 'source document name to record if the database has none')
+    args = parser.parse_args()
+
+    sql_engine, sql_session = open_db(args.db, savepoints = True, storage_profile = args.storage_profile)
+
+    if args.source_document and not get_source_document(sql_session):
+        Config.add_value(sql_session, 'Source', 'DocumentName', args.source_document)
+    if not get_source_document(sql_session):
+        sys.exit('The database has no source document name, give one with --source-document')
+
+    host, port = EntryServer.start(sql_engine, sql_session, args.host, args.port)
+    print('Entering cards for %s into %s, connect with log.py --server %s:%d' % (EntryServer.source_document, args.db, host, port))
+
+    backup_minutes = Config.get_int(sql_session, 'Backup', 'Minutes', Snapshotter.interval // 60)
+    if backup_minutes > 0:
+        Snapshotter.start(args.db, Config.get_value(sql_session, 'Backup', 'Directory'), backup_minutes * 60,
+                          lambda message: print('Backing up to %s failed: %s' % (Snapshotter.directory, message), file = sys.stderr))
+    else:
+        trim_journal(sql_session)
+    try:
+        while EntryServer.thread.is_alive():
+            EntryServer.thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    EntryServer.stop()
+    Snapshotter.stop()
+    sql_session.close()
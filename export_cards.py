@@ -0,0 +1,220 @@
+from sqlalchemy import select, Integer
+import argparse
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import time
+from log import FIELDS, Burial, Config, Snapshotter, default_db_path, open_db, trim_journal
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+COLUMNS = [column.name for column in Burial.__table__.columns]
+
+CHECKBOXES = [field.name for field in FIELDS if field.kind == 'checkbox']
+
+# References may be typed with dots, eg 12.5, so are published as text in parquet
+REFERENCES = [field.name for field in FIELDS if field.kind == 'reference']
+
+INTEGERS = [name for name in COLUMNS if isinstance(Burial.__table__.c[name].type, Integer)
+            and name not in CHECKBOXES + REFERENCES + ['confidence_level']]
+
+# Turn a burial row into the values published, the way they read on the form
+def export_row(row):
+    record = dict(row)
+    record['confidence_level'] = Burial.confidence_names.get(record['confidence_level'])
+    for name in CHECKBOXES:
+        if record[name] is not None:
+            record[name] = bool(record[name])
+
+    return record
+
+# Yield the rows after after_id in id order, batch_size at a time, or when ids
+# is given only those rows. The rows are fetched from a single cursor as they
+# are written so memory use does not grow with the table
+def read_batches(sql_session, after_id = 0, batch_size = 1000, ids = None):
+    if ids is not None:
+        yield from read_id_batches(sql_session, ids, batch_size)
+        return
+    stmt = (select(Burial.__table__)
+            .where(Burial.__table__.c.id > after_id)
+            .order_by(Burial.__table__.c.id)
+            .execution_options(stream_results = True))
+    with sql_session.begin():
+        result = sql_session.execute(stmt)
+        for rows in result.mappings().partitions(batch_size):
+            yield [export_row(row) for row in rows]
+
+# ids are looked up batch_size at a time, which also keeps each query under
+# SQLite's limit on parameters. Cards deleted since have no row and are left out
+def read_id_batches(sql_session, ids, batch_size):
+    ids = sorted(ids)
+    batch_size = min(batch_size, 500)
+    for start in range(0, len(ids), batch_size):
+        stmt = (select(Burial.__table__)
+                .where(Burial.__table__.c.id.in_(ids[start:start + batch_size]))
+                .order_by(Burial.__table__.c.id))
+        with sql_session.begin():
+            rows = [export_row(row) for row in sql_session.execute(stmt).mappings()]
+        if rows:
+            yield rows
+
+# The cards added or edited since the journal row after_seq, and the last
+# journal seq now. Snapshots remove journal rows once they are copied to
+# journal.db in the backup directory, so those are read from there. None is
+# returned for the cards when neither journal reaches back to after_seq
+def changed_ids(sql_session, after_seq, backup_directory):
+    with sql_session.begin():
+        last_seq = sql_session.execute("select seq from sqlite_sequence where name = 'burial_journal'").scalar() or 0
+        first_seq = sql_session.execute('select min(seq) from burial_journal').scalar() or last_seq + 1
+        ids = set(row[0] for row in sql_session.execute('select burial_id from burial_journal where seq > :after_seq and seq <= :last_seq',
+                                                        {'after_seq': after_seq, 'last_seq': last_seq}))
+    if first_seq > after_seq + 1:
+        journal_path = os.path.join(backup_directory, 'journal.db')
+        if not os.path.exists(journal_path):
+            return None, last_seq
+        journal = sqlite3.connect(journal_path)
+        try:
+            copied_first, copied_last = journal.execute('select min(seq), max(seq) from burial_journal').fetchone()
+            if copied_first is None or copied_first > after_seq + 1 or copied_last < first_seq - 1:
+                return None, last_seq
+            ids.update(row[0] for row in journal.execute('select burial_id from burial_journal where seq > ? and seq < ?',
+                                                         (after_seq, first_seq)))
+        finally:
+            journal.close()
+
+    return ids, last_seq
+
+def open_text(path, compress):
+    if compress:
+        return gzip.open(path, 'wt', encoding = 'utf-8', newline = '')
+    return open(path, 'w', encoding = 'utf-8', newline = '')
+
+def write_csv(path, batches, compress):
+    with open_text(path, compress) as file:
+        writer = csv.DictWriter(file, fieldnames = COLUMNS)
+        writer.writeheader()
+        for batch in batches:
+            writer.writerows(batch)
+            yield batch
+
+def write_jsonl(path, batches, compress):
+    with open_text(path, compress) as file:
+        for batch in batches:
+            file.write(''.join(json.dumps(record) + '\n' for record in batch))
+            yield batch
+
+# Parquet needs pyarrow, which is only required for this format. Each batch is
+# written as its own row group
+def write_parquet(path, batches, compress):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit('Exporting to parquet needs pyarrow, install it with pip install pyarrow')
+
+    fields = []
+    for name in COLUMNS:
+        if name in CHECKBOXES:
+            fields.append((name, pyarrow.bool_()))
+        elif name in INTEGERS:
+            fields.append((name, pyarrow.int64()))
+        else:
+            fields.append((name, pyarrow.string()))
+    schema = pyarrow.schema(fields)
+    writer = pyarrow.parquet.ParquetWriter(path, schema, compression = 'zstd' if compress else 'snappy')
+    try:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_pylist([parquet_row(record) for record in batch], schema = schema))
+            yield batch
+    finally:
+        writer.close()
+
+# SQLite will hand back a float or text from an integer column if that is what
+# was stored in it. References are written as they read in the csv export, a
+# value that will not fit an integer column stops the export rather than being lost
+def parquet_row(record):
+    for name in REFERENCES:
+        if isinstance(record[name], float) and record[name].is_integer():
+            record[name] = int(record[name])
+        if record[name] is not None:
+            record[name] = str(record[name])
+    for name in INTEGERS:
+        if isinstance(record[name], float) and record[name].is_integer():
+            record[name] = int(record[name])
+        elif record[name] is not None and not isinstance(record[name], int):
+            raise ValueError('Card %s has %s %r, which parquet can only hold as a whole number. Correct it or export to csv or jsonl'
+                             % (record['id'], name, record[name]))
+
+    return record
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}
+
+# Write the burial rows after after_id, or those in ids, to path, returning the
+# number of rows and the last id written
+def export_cards(sql_session, path, format, after_id = 0, batch_size = 1000, compress = False, progress = None, ids = None):
+    rows = 0
+    last_id = after_id
+    started = time.perf_counter()
+    for batch in WRITERS[format](path, read_batches(sql_session, after_id, batch_size, ids), compress):
+        rows += len(batch)
+        last_id = batch[-1]['id']
+        if progress:
+            progress(rows, time.perf_counter() - started)
+
+    return rows, last_id, time.perf_counter() - started
+
+def print_progress(rows, elapsed):
+    print('%d rows, %.0f rows/s' % (rows, rows / elapsed if elapsed > 0 else 0.0), file = sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export the burial table for publication')
+    parser.add_argument('file', help = 'file to write, a .gz suffix compresses csv and jsonl output')
+    parser.add_argument('--db', default = default_db_path(), help = 'database to export (default: %(default)s)')
+    parser.add_argument('--format', choices = FORMATS, help = 'output format, taken from the file name when not given')
+    parser.add_argument('--compress', action = 'store_true', help = 'gzip csv and jsonl output, use zstd for parquet')
+    parser.add_argument('--batch-size', type = int, default = 1000, help = 'rows fetched and written at a time (default: %(default)s)')
+    parser.add_argument('--since-last', metavar = 'NAME',
+                        help = 'only export rows added or edited since the last export with this name, and record this one. '
+                               'Deleted rows are not exported')
+    parser.add_argument('--quiet', action = 'store_true', help = 'only report the totals')
+    args = parser.parse_args()
+
+    name = args.file[:-3] if args.file.endswith('.gz') else args.file
+    format = args.format or os.path.splitext(name)[1].lstrip('.').lower()
+    if format not in FORMATS:
+        parser.error('cannot tell the format from the file name, use --format')
+    compress = args.compress or args.file.endswith('.gz')
+
+    if not os.path.exists(args.db):
+        sys.exit('There is no database at ' + args.db)
+
+    sql_engine, sql_session = open_db(args.db)
+
+    ids = None
+    if args.since_last:
+        # The watermark is the last journal seq when the export with this name was made.
+        # The first export with a name has everything
+        after_seq = Config.get_int(sql_session, 'Export', args.since_last, 0)
+        backup_directory = Config.get_value(sql_session, 'Backup', 'Directory') or Snapshotter.default_directory(args.db)
+        ids, last_seq = changed_ids(sql_session, after_seq, backup_directory)
+        if not after_seq:
+            ids = None
+        elif ids is None:
+            print('The journal no longer goes back to the last export, exporting every row', file = sys.stderr)
+
+    try:
+        rows, last_id, elapsed = export_cards(sql_session, args.file, format, 0, args.batch_size, compress,
+                                              None if args.quiet else print_progress, ids)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.since_last:
+        Config.set_value(sql_session, 'Export', args.since_last, str(last_seq))
+        trim_journal(sql_session)
+
+    print('Exported %d rows to %s in %.2fs' % (rows, args.file, elapsed))
+
+    sql_session.close()
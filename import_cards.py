@@ -0,0 +1,127 @@
+from sqlalchemy.exc import IntegrityError
+import argparse
+import csv
+import os
+import sys
+import time
+from log import CONFIDENCE_LEVELS, FIELDS, Burial, Config, default_db_path, get_source_document, open_db
+
+TRUE_VALUES = ('1', 'y', 'yes', 't', 'true', 'x')
+
+# Turn a row of the import file, its columns named as in the burial table, into the
+# values the entry form would produce so the record goes through the same conversions as Burial.save
+def row_to_values(row):
+    values = {}
+    for field in FIELDS:
+        value = row.get(field.name)
+        if value is None:
+            value = ''
+        if field.kind == 'checkbox':
+            values[field.key] = value.strip().lower() in TRUE_VALUES
+        elif field.kind == 'confidence':
+            # Matched whatever the case, anything else would be stored as not given
+            value = value.strip().capitalize()
+            if value and value not in CONFIDENCE_LEVELS:
+                raise ValueError('Unknown ' + field.name + ' ' + repr(row.get(field.name)) + ', expected ' + ', '.join(CONFIDENCE_LEVELS))
+            values[field.key] = value
+        else:
+            values[field.key] = value
+
+    return values
+
+def read_rows(file, delimiter):
+    reader = csv.DictReader(file, delimiter = delimiter)
+    missing = [name for name in ('given_names', 'family_name') if name not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError('The import file has no ' + ' or '.join(missing) + ' column')
+    for row in reader:
+        yield reader.line_num, row
+
+# Insert one batch in a single transaction. The batch is tried as one
+# executemany, if any row is rejected the batch is replayed row by row inside
+# savepoints so only the offending rows are skipped
+def insert_batch(sql_session, batch, rejects):
+    inserted = 0
+    with sql_session.begin():
+        try:
+            with sql_session.begin_nested():
+                sql_session.execute(Burial.__table__.insert(), [record for line, record in batch])
+            inserted = len(batch)
+        except IntegrityError:
+            for line, record in batch:
+                try:
+                    with sql_session.begin_nested():
+                        sql_session.execute(Burial.__table__.insert(), record)
+                    inserted += 1
+                except IntegrityError as e:
+                    rejects.append((line, str(e.orig)))
+
+    return inserted
+
+def import_cards(sql_session, file, delimiter = ',', batch_size = 1000, progress = None):
+    rejects = []
+    inserted = 0
+    rows = 0
+    batch = []
+    started = time.perf_counter()
+    for line, row in read_rows(file, delimiter):
+        rows += 1
+        try:
+            batch.append((line, Burial.values_to_record(row_to_values(row))))
+        except ValueError as e:
+            rejects.append((line, str(e)))
+        if len(batch) >= batch_size:
+            inserted += insert_batch(sql_session, batch, rejects)
+            batch = []
+            if progress:
+                progress(rows, inserted, time.perf_counter() - started)
+    if batch:
+        inserted += insert_batch(sql_session, batch, rejects)
+    elapsed = time.perf_counter() - started
+    if progress:
+        progress(rows, inserted, elapsed)
+
+    return rows, inserted, rejects, elapsed
+
+def rate(rows, elapsed):
+    if elapsed > 0:
+        return rows / elapsed
+    return 0.0
+
+def print_progress(rows, inserted, elapsed):
+    print('%d rows read, %d inserted, %.0f rows/s' % (rows, inserted, rate(rows, elapsed)), file = sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Import transcribed cards from a CSV or TSV file into the burial table')
+    parser.add_argument('file', help = 'CSV or TSV file with a header row naming the burial columns')
+    parser.add_argument('--db', default = default_db_path(), help = 'database to import into (default: %(default)s)')
+    parser.add_argument('--batch-size', type = int, default = 1000, help = 'rows inserted per transaction (default: %(default)s)')
+    parser.add_argument('--delimiter', help = 'field delimiter, defaults to tab for .tsv files and comma otherwise')
+    parser.add_argument('--source-document', help = 'source document name to record if the database has none')
+    parser.add_argument('--quiet', action = 'store_true', help = 'only report the totals')
+    args = parser.parse_args()
+
+    if args.delimiter:
+        delimiter = args.delimiter
+    elif os.path.splitext(args.file)[1].lower() in ('.tsv', '.tab'):
+        delimiter = '\t'
+    else:
+        delimiter = ','
+
+    sql_engine, sql_session = open_db(args.db, savepoints = True)
+
+    if args.source_document and not get_source_document(sql_session):
+        Config.add_value(sql_session, 'Source', 'DocumentName', args.source_document)
+
+    with open(args.file, newline = '', encoding = 'utf-8-sig') as file:
+        try:
+            rows, inserted, rejects, elapsed = import_cards(sql_session, file, delimiter, args.batch_size,
+                                                            None if args.quiet else print_progress)
+        except ValueError as e:
+            sys.exit(str(e))
+
+    for line, reason in rejects:
+        print('Line %d rejected: %s' % (line, reason), file = sys.stderr)
+    print('Imported %d of %d rows in %.2fs (%.0f rows/s), %d rejected' % (inserted, rows, elapsed, rate(rows, elapsed), len(rejects)))
+
+    sql_session.close()
@@ -1,66 +1,320 @@
-from sqlalchemy import select, create_engine, Table, Column, Integer, Float, String, func, and_, desc
+import time
+
+# Taken before anything else is imported so StartupTimer covers the imports too
+STARTED = time.perf_counter()
+
+from sqlalchemy import event, select, update, create_engine, table, column, tuple_, Table, Column, Integer, Float, String, Text, func, and_, desc
 from sqlalchemy.orm import Session, declarative_base
-from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.exc import IntegrityError
+import argparse
+import collections
+import hashlib
+import json
 import sys
 import os
-import PySimpleGUI as sg
+import datetime
+import difflib
+import queue
+import re
+import socket
+import sqlite3
+import threading
+import traceback
+
+VERSION = 'V1.11'
+
+Base = declarative_base()
+
+# PySimpleGUI is only imported when a window is needed, see load_gui, so the
+# headless tools start without it
+sg = None
+
+def load_gui():
+    global sg
+    if sg is None:
+        import PySimpleGUI
+        sg = PySimpleGUI
+        sg.theme('BlueMono')
 
-VERSION = 'V1.07'
+# Records how long each stage of starting up took, in seconds since STARTED
+class StartupTimer:
+    marks = []
 
-Base = automap_base()
+    def mark(stage):
+        StartupTimer.marks.append((stage, time.perf_counter() - STARTED))
 
-sg.theme('BlueMono')
+    def report():
+        return {'version': VERSION, 'stages': dict(StartupTimer.marks)}
+
+StartupTimer.mark('imports')
 
 class Config(Base):
     __tablename__ = 'config'
+    id = Column(Integer, primary_key = True)
+    domain = Column(String(256), nullable = False)
+    name = Column(String(256), nullable = False)
+    value = Column(String(256))
+
+    # Config values for each open database keyed on (domain, name). The table
+    # is read once, on the first lookup, and the writes below keep it current
+    caches = {}
+
+    def cache(sql_session):
+        key = str(sql_session.bind.url)
+        if key not in Config.caches:
+            values = {}
+            with sql_session.begin():
+                # Rows are read in id order so the newest of any duplicates wins, as it always has
+                for c in sql_session.execute(select(Config).order_by(Config.id)).scalars():
+                    values[(c.domain, c.name)] = c.value
+            Config.caches[key] = values
+
+        return Config.caches[key]
+
+    # Forget the cached values, for when another process may have changed them
+    def invalidate(sql_session = None):
+        if sql_session is None:
+            Config.caches.clear()
+        else:
+            Config.caches.pop(str(sql_session.bind.url), None)
 
     def get_value(sql_session, domain, name):
+        return Config.cache(sql_session).get((domain, name))
+
+    def get_int(sql_session, domain, name, default = None):
+        value = Config.get_value(sql_session, domain, name)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(sql_session, domain, name, default = None):
+        value = Config.get_value(sql_session, domain, name)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(sql_session, domain, name, default = False):
+        value = Config.get_value(sql_session, domain, name)
+        if value is None:
+            return default
+        return value.strip().lower() in ('1', 'y', 'yes', 't', 'true', 'on')
+
+    # Add a config row, the newest row for a (domain, name) is the one that counts
+    def add_value(sql_session, domain, name, value):
+        values = Config.cache(sql_session)
+        with sql_session.begin():
+            config = Config()
+            config.domain = domain
+            config.name = name
+            config.value = value
+            sql_session.add(config)
+        values[(domain, name)] = value
+
+    # Change every matching config row, adding one if there are none
+    def set_value(sql_session, domain, name, value):
+        values = Config.cache(sql_session)
         with sql_session.begin():
             config = sql_session.execute(select(Config)
                                          .where(and_(Config.domain == domain,
                                                      Config.name == name))).scalars().all()
             if len(config) > 0:
                 for c in config:
-                    value = c.value
+                    c.value = value
             else:
-                value = None
+                c = Config()
+                c.domain = domain
+                c.name = name
+                c.value = value
+                sql_session.add(c)
+        values[(domain, name)] = value
 
-        return value
+# One entry for each field on a card, in the order they appear on the form.
+# The kind decides which widgets the field gets, how its form value becomes a
+# burial column value and what may be typed into it; row is the form row its
+# widgets go on. The form, Burial.values_to_record and the import and export
+# tools are all driven from this table.
+class Field(collections.namedtuple('Field', ('name', 'kind', 'row', 'label', 'tooltip', 'size'), defaults = (None,))):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return '-' + self.name + '-'
+
+FIELDS = (
+    Field('given_names', 'name', 1, 'Given Names', 'Enter the given names for the record, eg Fredric William'),
+    Field('family_name', 'name', 2, 'Family Name', 'Enter the family name for the record, eg Smith'),
+    Field('date_of_birth', 'date', 3, 'Date of Birth', 'Enter date of birth if known'),
+    Field('date_of_death', 'date', 4, 'Date of Death', 'Enter date of death, if only year is known select 1st January'),
+    Field('date_of_burial', 'date', 4, 'Burial Date', 'Enter date of burial, if only year is known select 1st January'),
+    Field('ashes', 'checkbox', 4, 'Ashes', 'Click if ashes are being intered'),
+#    Field('grave_full', 'checkbox', 4, 'Grave Full', 'Click if grave is full'),
+    Field('age_years', 'age', 5, 'Age Years', 'Enter an age in years', (6, 1)),
+    Field('age_months', 'age', 5, 'Age Months', 'Enter the age months, usually used for infants', (6, 1)),
+    Field('age_days', 'age', 5, 'Age Days', 'Enter the age days, usually used for infants', (6, 1)),
+    Field('stillborn', 'checkbox', 5, 'Stillborn', 'Click if stillborn, cannot be used if any of the age fields are set'),
+    Field('source_document_ref', 'reference', 6, 'Document reference', 'Enter the document reference number', (5, 1)),
+    Field('cross_reference', 'reference', 6, 'Cross reference', 'Enter the cross reference to a previous entry', (5, 1)),
+    Field('page_number', 'number', 7, 'Page number', 'Enter the document page number for the record', (4, 1)),
+    Field('see_page_number', 'text', 7, 'See page number(s)', 'Enter any page number cross reference', (25, 1)),
+    Field('plot', 'text', 8, 'Plot', 'Enter the plot identification for the grave', (15, 1)),
+    Field('plot_row', 'text', 8, 'Row', 'Enter the plot row identification for the grave', (15, 1)),
+    Field('plot_row_number', 'text', 8, 'Number', 'Enter the plot row number of the grave', (15, 1)),
+    Field('notes', 'multiline', 9, 'Notes', 'Enter any notes or text that does not fit in other fields', (50, 5)),
+    Field('confidence_level', 'confidence', 10, 'Data Entry Confidence', 'Select a confidence level of the data entered', (8, 1)),
+)
+
+# confidence_level is stored as a number, 0 when it was not given
+CONFIDENCE_LEVELS = {'High': 3, 'Medium': 2, 'Low': 1}
+
+FIELDS_BY_NAME = {field.name: field for field in FIELDS}
+
+def text_value(value):
+    value = value.rstrip()
+    if value == '':
+        return None
+    return value
+
+def int_value(value):
+    value = text_value(value)
+    if value is None:
+        return None
+    return int(value)
+
+# Form value to column value for each kind of field
+CONVERTERS = {'name': text_value,
+              'date': text_value,
+              'text': text_value,
+              'reference': text_value,
+              'number': text_value,
+              'multiline': text_value,
+              'age': int_value,
+              'checkbox': bool,
+              'confidence': lambda value: CONFIDENCE_LEVELS.get(value, 0)}
+
+# What a field of each kind holds on a blank form
+BLANK = {'checkbox': False, 'confidence': 'High'}
+
+# Anything typed into these kinds of field from the first character that does not match is dropped
+INVALID = {'age': re.compile('[^0-9]'),
+           'number': re.compile('[^0-9]'),
+           'reference': re.compile('[^0-9.]')}
 
 class Burial(Base):
     __tablename__ = 'burial'
-    input_given_names = sg.Input(tooltip = 'Enter the given names for the record, eg Fredric William', key = '-given_names-', enable_events = True, focus = True)
-    input_family_name = sg.Input(tooltip = 'Enter the family name for the record, eg Smith', key = '-family_name-', enable_events = True)
-    button_date_of_birth = sg.CalendarButton('Date of Birth', auto_size_button = True, target = '-date_of_birth-', no_titlebar = False, tooltip = 'Enter date of birth if known', format = '%Y-%m-%d', title = 'Date of Birth')
-    input_date_of_birth = sg.Input(key = '-date_of_birth-', readonly = True, size = (12, 1))
-    button_date_of_death = sg.CalendarButton('Date of Death', auto_size_button = True, target = '-date_of_death-', no_titlebar = False, tooltip = 'Enter date of death, if only year is known select 1st January', format = '%Y-%m-%d', title = 'Burial Date')
-    input_date_of_death = sg.Input(key = '-date_of_death-', readonly = True, size = (12, 1))
-    button_date_of_burial = sg.CalendarButton('Burial Date', auto_size_button = True, target = '-date_of_burial-', no_titlebar = False, tooltip = 'Enter date of burial, if only year is known select 1st January', format = '%Y-%m-%d', title = 'Burial Date')
-    input_date_of_burial = sg.Input(key = '-date_of_burial-', readonly = True, size = (12, 1))
-    checkbox_ashes = sg.Checkbox('Ashes', tooltip = 'Click if ashes are being intered', key = '-ashes-')
-#    checkbox_grave_full = sg.Checkbox('Grave Full', tooltip = 'Click if grave is full', key = '-grave_full-')
-    text_age_years = sg.Text('Age Years', key = '#age_years#')
-    input_age_years = sg.Input(tooltip = 'Enter an age in years', size = (6, 1), enable_events = True, key = '-age_years-')
-    text_age_months = sg.Text('Age Months', key = '#age_months#')
-    input_age_months = sg.Input(tooltip = 'Enter the age months, usually used for infants', size = (6, 1), enable_events = True, key = '-age_months-')
-    text_age_days = sg.Text('Age Days', key = '#age_days#')
-    input_age_days = sg.Input(tooltip = 'Enter the age days, usually used for infants', size = (6, 1), enable_events = True, key = '-age_days-')
-    checkbox_stillborn = sg.Checkbox('Stillborn', tooltip = 'Click if stillborn, cannot be used if any of the age fields are set', enable_events = True, key = '-stillborn-')
-    input_source_document_ref = sg.Input(tooltip = 'Enter the document reference number', size = (5, 1), enable_events = True, key = '-source_document_ref-')
-    input_cross_reference = sg.Input(tooltip = 'Enter the cross reference to a previous entry', size = (5, 1), enable_events = True, key = '-cross_reference-')
-    input_page_number = sg.Input(tooltip = 'Enter the document page number for the record', size = (4, 1), enable_events = True, key = '-page_number-')
-    input_see_page_number = sg.Input(tooltip = 'Enter any page number cross reference', size = (25, 1), enable_events = True, key = '-see_page_number-')
-    input_plot = sg.Input(tooltip = 'Enter the plot identification for the grave', size = (15, 1), key = '-plot-')
-    input_plot_row = sg.Input(tooltip = 'Enter the plot row identification for the grave', size = (15, 1), key = '-plot_row-')
-    input_plot_row_number = sg.Input(tooltip = 'Enter the plot row number of the grave', size = (15, 1), enable_events = True, key = '-plot_row_number-')
-    multiline_notes = sg.Multiline(autoscroll = True, size = (50, 5), key = '-notes-', tooltip = 'Enter any notes or text that does not fit in other fields')
-    spin_confidence_level = sg.Spin(('Low', 'Medium', 'High'), initial_value = 'High', size = (8, 1), key = '-confidence_level-', tooltip = 'Select a confidence level of the data entered')
-    button_save = sg.Button('Save')
-    records_entered = sg.Text('Records entered: 0', font = (None, 14))
+    id = Column(Integer, primary_key = True)
+    given_names = Column(String(256), nullable = False)
+    family_name = Column(String(256), nullable = False)
+    date_of_birth = Column(String(32))
+    date_of_death = Column(String(32))
+    date_of_burial = Column(String(32))
+    ashes = Column(Integer)
+    age_years = Column(Integer)
+    age_months = Column(Integer)
+    age_days = Column(Integer)
+    stillborn = Column(Integer)
+    source_document_ref = Column(Integer, unique = True)
+    cross_reference = Column(Integer)
+    page_number = Column(Integer)
+    see_page_number = Column(String(256))
+    plot = Column(String(32))
+    plot_row = Column(String(32))
+    plot_row_number = Column(String(32))
+    notes = Column(Text)
+    confidence_level = Column(Integer)
+
+    confidence_names = {level: name for name, level in CONFIDENCE_LEVELS.items()}
 
     default_plot = None
 
+    # The id of the card being edited, None when the form is for a new card
+    editing = None
+
+    # Cards the background writer could not save, put back in the form one at a time when it is free
+    unsaved = []
+
+    # What each field that completes holds now, including any completion, and what was typed
+    # in it before that completion. A value shorter than what was typed means characters were deleted
+    shown = {}
+    typed = {}
+
+    # The grave is looked up when one of these fields is left, not on every key typed in them
+    grave_fields = ('plot', 'plot_row', 'plot_row_number')
+    left = '+left'
+
+    # Widgets by key, and what they were last set to so updates that change nothing can be skipped
+    elements = {}
+    states = {}
+    invalid = {field.key: INVALID[field.kind] for field in FIELDS if field.kind in INVALID}
+
+    # The form's widgets are made on first use, after PySimpleGUI has been loaded
+    def build_widgets():
+        Burial.elements = {}
+        Burial.states = {}
+        Burial.rows = {}
+        for field in FIELDS:
+            Burial.rows.setdefault(field.row, []).extend(Burial.field_widgets(field))
+        Burial.listbox_duplicates = sg.Listbox([], size = (50, 3), font = (None, 14), key = '-duplicates-', tooltip = 'Cards already entered with similar names')
+        Burial.listbox_occupants = sg.Listbox([], size = (50, 3), font = (None, 14), key = '-occupants-', tooltip = 'Cards already entered for this grave')
+        Burial.text_grave = sg.Text('', size = (30, 2), font = (None, 14), key = '-grave-')
+        Burial.button_save = sg.Button('Save')
+        Burial.records_entered = sg.Text('Records entered: 0', font = (None, 14))
+        Burial.text_unsaved = sg.Text('', size = (20, 1), font = (None, 14), text_color = 'red', key = '-unsaved-')
+        for element in (Burial.listbox_duplicates, Burial.listbox_occupants, Burial.text_grave, Burial.button_save, Burial.records_entered,
+                        Burial.text_unsaved):
+            Burial.elements[element.key] = element
+
+    # The widgets for one field, each is also kept as a Burial attribute named after its type and the field
+    def field_widgets(field):
+        if field.kind == 'name':
+            label = sg.Text(field.label, size = (12, 1), text_color = 'red')
+            element = sg.Input(tooltip = field.tooltip, key = field.key, enable_events = True, focus = field is FIELDS[0])
+            widgets = [label, element]
+        elif field.kind == 'date':
+            button = sg.CalendarButton(field.label, auto_size_button = True, target = field.key, no_titlebar = False, tooltip = field.tooltip, format = '%Y-%m-%d', title = field.label)
+            setattr(Burial, 'button_' + field.name, button)
+            element = sg.Input(key = field.key, readonly = True, size = (12, 1))
+            widgets = [button, element]
+        elif field.kind == 'checkbox':
+            element = sg.Checkbox(field.label, tooltip = field.tooltip, enable_events = True, key = field.key)
+            widgets = [element]
+        elif field.kind == 'multiline':
+            element = sg.Multiline(autoscroll = True, size = field.size, key = field.key, tooltip = field.tooltip)
+            widgets = [sg.Text(field.label), element]
+        elif field.kind == 'confidence':
+            element = sg.Spin(('Low', 'Medium', 'High'), initial_value = 'High', size = field.size, key = field.key, tooltip = field.tooltip)
+            widgets = [sg.Text(field.label), element]
+        else:
+            if field.kind == 'age':
+                label = sg.Text(field.label, key = '#' + field.name + '#')
+                setattr(Burial, 'text_' + field.name, label)
+                Burial.elements[label.key] = label
+            else:
+                label = sg.Text(field.label)
+            element = sg.Input(tooltip = field.tooltip, size = field.size, enable_events = True, key = field.key)
+            widgets = [label, element]
+        prefix = {'checkbox': 'checkbox_', 'multiline': 'multiline_', 'confidence': 'spin_'}.get(field.kind, 'input_')
+        setattr(Burial, prefix + field.name, element)
+        Burial.elements[field.key] = element
+
+        return widgets
+
+    # Events the widgets cannot be given until the window has been made
+    def bind_events():
+        for name in Burial.grave_fields:
+            Burial.elements[FIELDS_BY_NAME[name].key].bind('<FocusOut>', Burial.left)
+
+    # Update an element only with what differs from the last time it was set
+    def set_state(key, **state):
+        changed = {}
+        for name, value in state.items():
+            if (key, name) not in Burial.states or Burial.states[(key, name)] != value:
+                changed[name] = value
+                Burial.states[(key, name)] = value
+        if changed:
+            Burial.elements[key].update(**changed)
+
     def set_default_plot(default_plot):
         Burial.default_plot = default_plot
 
@@ -78,196 +332,281 @@ class Burial(Base):
         return value
 
     def gui_layout(source_document):
-        return [[sg.Text(source_document, expand_x = True, justification = 'center', font = (None, 25))],
-                [sg.Text('Given Names', size = (12, 1), text_color = 'red'), Burial.input_given_names],
-                [sg.Text('Family Name', size = (12, 1), text_color = 'red'), Burial.input_family_name],
-                [Burial.button_date_of_birth, Burial.input_date_of_birth],
-                [Burial.button_date_of_death,
-                 Burial.input_date_of_death,
-                 Burial.button_date_of_burial,
-                 Burial.input_date_of_burial,
-                 Burial.checkbox_ashes],
-#                 Burial.checkbox_grave_full],
-                [Burial.text_age_years, Burial.input_age_years,
-                 Burial.text_age_months, Burial.input_age_months,
-                 Burial.text_age_days, Burial.input_age_days,
-                 Burial.checkbox_stillborn],
-                [sg.Text('Document reference'), Burial.input_source_document_ref,
-                 sg.Text('Cross reference'), Burial.input_cross_reference],
-                [sg.Text('Page number'), Burial.input_page_number,
-                 sg.Text('See page number(s)'), Burial.input_see_page_number],
-                [sg.Text('Plot'), Burial.input_plot, sg.Text('Row'), Burial.input_plot_row, sg.Text('Number'), Burial.input_plot_row_number],
-                [sg.Text('Notes'), Burial.multiline_notes],
-                [sg.Text('Data Entry Confidence'), Burial.spin_confidence_level],
-                [sg.Button('Clear'), Burial.button_save, Burial.records_entered]]
-
-    def gui_layout_new_record():
+        Burial.build_widgets()
+        # The duplicates follow the names and the grave's occupants follow the plot
+        after = {FIELDS_BY_NAME['family_name'].row: [sg.Text('Possible duplicates', font = (None, 14)), Burial.listbox_duplicates],
+                 FIELDS_BY_NAME['plot_row_number'].row: [sg.Text('In this grave', font = (None, 14)), Burial.listbox_occupants, Burial.text_grave]}
+        layout = [[sg.Text(source_document, expand_x = True, justification = 'center', font = (None, 25))]]
+        for row in sorted(Burial.rows):
+            layout.append(Burial.rows[row])
+            if row in after:
+                layout.append(after[row])
+        layout.append([sg.Button('Clear'), Burial.button_save, sg.Button('Review'), Burial.records_entered, Burial.text_unsaved])
+
+        return layout
+
+    # The values a new card starts with, carrying on from the cards already entered
+    def new_record_values():
+        target = {}
+        for field in FIELDS:
+            target[field.key] = BLANK.get(field.kind, '')
+        if EntryClient.connection is not None:
+            # The server hands out refs so two people cannot be given the same one
+            ref = EntryClient.reserve()
+            if ref is not None:
+                target['-source_document_ref-'] = str(ref)
+        elif BurialStats.row_count > 0 and BurialStats.source_document_ref:
+            target['-source_document_ref-'] = str(int(BurialStats.source_document_ref) + 1)
+        if BurialStats.row_count > 0 and BurialStats.page_number:
+            target['-page_number-'] = str(BurialStats.page_number)
+        if Burial.default_plot is not None:
+            target['-plot-'] = Burial.default_plot
+
+        return target
+
+    # Reset the form for the next card. values, when given, are what the form
+    # holds now and only the fields that differ from the new card are updated
+    def gui_layout_new_record(values = None):
         Burial.input_given_names.set_focus()
-        Burial.input_given_names.update(value = '')
-        Burial.input_family_name.update(value = '')
-        Burial.input_date_of_birth.update(value = '')
-        Burial.input_date_of_death.update(value = '')
-        Burial.input_date_of_burial.update(value = '')
-        Burial.checkbox_ashes.update(value = False)
- #       Burial.checkbox_grave_full.update(value = False)
-        Burial.text_age_years.update(text_color = 'black')
-        Burial.input_age_years.update(value = '', disabled = False)
-        Burial.text_age_months.update(text_color = 'black')
-        Burial.input_age_months.update(value = '', disabled = False)
-        Burial.text_age_days.update(text_color = 'black')
-        Burial.input_age_days.update(value = '', disabled = False)
-        Burial.checkbox_stillborn.update(value = False, disabled = False)
-        Burial.input_see_page_number.update(value = '')
-        Burial.input_cross_reference.update(value = '')
-        Burial.input_plot.update(value = '')
-        Burial.input_plot_row.update(value = '')
-        Burial.input_plot_row_number.update(value = '')
-        Burial.multiline_notes.update(value = '')
-        Burial.spin_confidence_level.update(value = 'High')
-        Burial.button_save.update(disabled = True)
+        Burial.editing = None
+        Burial.set_state('Save', text = 'Save')
+        target = Burial.new_record_values()
+        Burial.reset_completion(target)
+        for key, value in target.items():
+            if values is None or str(values.get(key)) != str(value):
+                Burial.elements[key].update(value = value)
+        Burial.update_age_states({})
+        Burial.show_grave(target)
+        Burial.set_state('Save', disabled = True)
+        Burial.set_state('-duplicates-', values = [])
+        DuplicateFinder.cancel()
 
-        with sql_session.begin():
-            row_count = sql_session.query(Burial).count()
-        Burial.records_entered.update(value = 'Records entered: ' + str(row_count))
-        if row_count == 0:
-            Burial.button_date_of_birth.calendar_default_date_M_D_Y = (1, None, 1900)
-            Burial.button_date_of_death.calendar_default_date_M_D_Y = (1, None, 1900)
-            Burial.button_date_of_burial.calendar_default_date_M_D_Y = (1, None, 1900)
-            Burial.input_source_document_ref.update(value = '')
-            Burial.input_page_number.update(value = '')
+        Burial.set_state(Burial.records_entered.key, value = 'Records entered: ' + str(BurialStats.row_count))
+        for field in FIELDS:
+            if field.kind == 'date':
+                date = getattr(BurialStats, field.name) if BurialStats.row_count > 0 else None
+                if date:
+                    date_bits = date.split('-')
+                    getattr(Burial, 'button_' + field.name).calendar_default_date_M_D_Y = (int(date_bits[1]), None, int(date_bits[0]))
+                else:
+                    getattr(Burial, 'button_' + field.name).calendar_default_date_M_D_Y = (1, None, 1900)
+
+    # Stillborn and the ages exclude each other, grey out whichever cannot be used
+    def update_age_states(values):
+        stillborn = bool(values.get('-stillborn-'))
+        any_age = any(values.get(field.key) for field in FIELDS if field.kind == 'age')
+        for field in FIELDS:
+            if field.kind == 'age':
+                Burial.set_state(field.key, disabled = stillborn)
+                Burial.set_state('#' + field.name + '#', text_color = 'grey' if stillborn else 'black')
+        Burial.set_state('-stillborn-', disabled = any_age)
+
+    # Drop everything from the first character the field does not allow
+    def validate(values, key):
+        value = values[key]
+        invalid = Burial.invalid[key].search(value)
+        if invalid:
+            value = value[:invalid.start()]
+            Burial.elements[key].update(value)
+            values[key] = value
+
+        return value
+
+    def on_name(values, event):
+        Burial.set_state('Save', disabled = len(values['-given_names-']) == 0 or len(values['-family_name-']) == 0)
+        DuplicateFinder.request(values)
+
+    def on_age(values, event):
+        Burial.validate(values, event)
+        Burial.update_age_states(values)
+
+    def on_validate(values, event):
+        Burial.validate(values, event)
+
+    def on_stillborn(values, event):
+        Burial.update_age_states(values)
+
+    def on_grave(values, event):
+        Burial.show_grave(values)
+
+    def reset_completion(values):
+        Burial.shown = {FIELDS_BY_NAME[name].key: str(values.get(FIELDS_BY_NAME[name].key, '')) for name in Completer.fields}
+        Burial.typed = dict(Burial.shown)
+
+    # Fill in the rest of the commonest value starting with what has been typed, selected
+    # so the next key typed replaces it. Every key fires an event, Tab, Shift and the arrows
+    # included, so only a change to what the field shows counts as typing, and nothing is
+    # filled in while characters are deleted
+    def complete(values, key, name):
+        typed = values[key]
+        if typed == Burial.shown.get(key, ''):
+            return
+        previous = Burial.typed.get(key, '')
+        Burial.shown[key] = typed
+        Burial.typed[key] = typed
+        if not typed or previous.startswith(typed):
+            return
+        if EntryClient.connection is not None:
+            completion = EntryClient.complete(name, typed)
         else:
-            stmt = select(func.min(Column('date_of_birth', String)).label('date_of_birth'),
-                          func.max(Column('date_of_death', String)).label('date_of_death'),
-                          func.max(Column('date_of_burial', String)).label('date_of_burial'),
-                          func.max(Column('source_document_ref', Integer)).label('source_document_ref'),
-                          func.max(Column('page_number', Integer)).label('page_number')).select_from(Burial)
+            completion = Completer.complete(name, typed)
+        if completion is None:
+            return
+        # The value is shown as it was entered, Smith rather than smith
+        value = completion
+        widget = Burial.elements[key].Widget
+        Burial.elements[key].update(value = value)
+        widget.select_range(len(typed), 'end')
+        widget.icursor(len(typed))
+        Burial.shown[key] = value
+        values[key] = value
+
+    # Complete the field before its own handler sees it
+    def completing(handler, name):
+        def on_complete(values, event):
+            Burial.complete(values, event, name)
+            if handler is not None:
+                handler(values, event)
+
+        return on_complete
+
+    # Who is in a grave, how many of them are coffins and the (burials, graves)
+    # in its plot, or None while the grave index is being built
+    def describe_grave(sql_session, plot, plot_row, plot_row_number):
+        occupants = GraveIndex.occupants(plot, plot_row, plot_row_number)
+        plot_counts = GraveIndex.plot_counts(plot)
+        if occupants is None or plot_counts is None:
+            return None
+        ids, coffins = occupants
+        described = []
+        if ids:
             with sql_session.begin():
-                result = sql_session.execute(stmt)
-                for r in result:
-                    if r['date_of_birth']:
-                        date_bits = r['date_of_birth'].split('-')
-                        Burial.button_date_of_birth.calendar_default_date_M_D_Y = (int(date_bits[1]), None, int(date_bits[0]))
-                    else:
-                        Burial.button_date_of_birth.calendar_default_date_M_D_Y = (1, None, 1900)
-                        Burial.input_date_of_birth.update(value = '')
-                    if r['date_of_death']:
-                        date_bits = r['date_of_death'].split('-')
-                        Burial.button_date_of_death.calendar_default_date_M_D_Y = (int(date_bits[1]), None, int(date_bits[0]))
-                    else:
-                        Burial.button_date_of_death.calendar_default_date_M_D_Y = (1, None, 1900)
-                        Burial.input_date_of_death.update(value = '')
-                    if r['date_of_burial']:
-                        date_bits = r['date_of_burial'].split('-')
-                        Burial.button_date_of_burial.calendar_default_date_M_D_Y = (int(date_bits[1]), None, int(date_bits[0]))
-                    else:
-                        Burial.button_date_of_burial.calendar_default_date_M_D_Y = (1, None, 1900)
-                        Burial.input_date_of_burial.update(value = '')
-                    if r['source_document_ref']:
-                        Burial.input_source_document_ref.update(value = str(int(r['source_document_ref']) + 1))
-                    else:
-                        Burial.input_source_document_ref.update(value = '')
-                    if r['page_number']:
-                        Burial.input_page_number.update(value = r['page_number'])
-                    else:
-                        Burial.input_page_number.update(value = '')
-        if Burial.default_plot is None:
-            Burial.input_plot.update(value = '')
-        else:
-            Burial.input_plot.update(value = Burial.default_plot)
+                for burial in sql_session.execute(select(Burial).where(Burial.id.in_(ids)).order_by(Burial.id)).scalars():
+                    described.append(DuplicateFinder.describe(burial))
 
-    def save(values):
-        burial = Burial()
-        if values['-given_names-'].rstrip() == '':
-            burial.given_names = None
-        else:
-            burial.given_names = values['-given_names-'].rstrip()
-        if values['-family_name-'].rstrip() == '':
-            burial.family_name = None
-        else:
-            burial.family_name = values['-family_name-'].rstrip()
-        if values['-date_of_birth-'] == '':
-            burial.date_of_birth = None
-        else:
-            burial.date_of_birth = values['-date_of_birth-']
-        if values['-date_of_death-'] == '':
-            burial.date_of_death = None
-        else:
-            burial.date_of_death = values['-date_of_death-']
-        if values['-date_of_burial-'] == '':
-            burial.date_of_burial = None
-        else:
-            burial.date_of_burial = values['-date_of_burial-']
-        if values['-ashes-']:
-            burial.ashes = True
-        else:
-            burial.ashes = False
-#        if values['-grave_full-']:
-#            burial.grave_full = True
-#        else:
-#            burial.grave_full = False
-        if values['-age_years-'] == '':
-            burial.age_years = None
-        else:
-            burial.age_years = int(values['-age_years-'])
-        if values['-age_months-'] == '':
-            burial.age_months = None
-        else:
-            burial.age_months = int(values['-age_months-'])
-        if values['-age_days-'] == '':
-            burial.age_days = None
-        else:
-            burial.age_days = int(values['-age_days-'])
-        if values['-source_document_ref-'] == '':
-            burial.source_document_ref = None
-        else:
-            burial.source_document_ref = values['-source_document_ref-'].rstrip()
-        if values['-stillborn-']:
-            burial.stillborn = True
-        else:
-            burial.stillborn = False
-        if values['-cross_reference-'] == '':
-            burial.cross_reference = None
-        else:
-            burial.cross_reference = values['-cross_reference-'].rstrip()
-        if values['-page_number-'] == '':
-            burial.page_number = None
-        else:
-            burial.page_number = values['-page_number-']
-        if values['-see_page_number-'] == '':
-            burial.see_page_number = None
-        else:
-            burial.see_page_number = values['-see_page_number-']
-        if values['-plot-'] == '':
-            burial.plot = None
-        else:
-            burial.plot = values['-plot-'].rstrip()
-        if values['-plot_row-'] == '':
-            burial.plot_row = None
-        else:
-            burial.plot_row = values['-plot_row-'].rstrip()
-        if values['-plot_row_number-'] == '':
-            burial.plot_row_number = None
+        return described, coffins, plot_counts
+
+    # List who is already in the grave the card is for, and warn when it looks full
+    def show_grave(values):
+        if EntryClient.connection is not None:
+            grave = EntryClient.grave(values['-plot-'], values['-plot_row-'], values['-plot_row_number-'])
         else:
-            burial.plot_row_number = values['-plot_row_number-'].rstrip()
-        if values['-notes-'] == '':
-            burial.notes = None
+            grave = Burial.describe_grave(sql_session, values['-plot-'], values['-plot_row-'], values['-plot_row_number-'])
+        if grave is None:
+            Burial.set_state('-occupants-', values = [])
+            Burial.set_state('-grave-', value = '')
+            return
+        described, coffins, plot_counts = grave
+        Burial.set_state('-occupants-', values = described)
+        if GraveIndex.likely_full(coffins):
+            Burial.set_state('-grave-', value = 'Grave likely full, ' + str(coffins) + ' coffins', text_color = 'red')
+        elif plot_counts[0]:
+            Burial.set_state('-grave-', value = 'Plot has ' + str(plot_counts[0]) + ' burials in ' + str(plot_counts[1]) + ' graves', text_color = 'black')
         else:
-            burial.notes = values['-notes-'].rstrip()
-        if values['-confidence_level-'] in ('High', 'Medium', 'Low'):
-            if values['-confidence_level-'] == 'High':
-                burial.confidence_level = 3
-            elif values['-confidence_level-'] == 'Medium':
-                burial.confidence_level = 2
+            Burial.set_state('-grave-', value = '', text_color = 'black')
+
+    # The form's event handlers by key, built from FIELDS
+    def event_handlers():
+        handlers = {}
+        for field in FIELDS:
+            if field.kind == 'name':
+                handlers[field.key] = Burial.on_name
+            elif field.kind == 'age':
+                handlers[field.key] = Burial.on_age
+            elif field.kind in INVALID:
+                handlers[field.key] = Burial.on_validate
+        handlers['-stillborn-'] = Burial.on_stillborn
+        for name in Burial.grave_fields:
+            handlers[FIELDS_BY_NAME[name].key + Burial.left] = Burial.on_grave
+        for name in Completer.fields:
+            key = FIELDS_BY_NAME[name].key
+            handlers[key] = Burial.completing(handlers.get(key), name)
+
+        return handlers
+
+    # Convert the values read from the entry form into burial column values
+    def values_to_record(values):
+        record = {}
+        for field in FIELDS:
+            record[field.name] = CONVERTERS[field.kind](values[field.key])
+
+        return record
+
+    def save(values):
+        record = Burial.values_to_record(values)
+        if Burial.editing is not None:
+            try:
+                Burial.update_record(sql_session, Burial.editing, record)
+            except IntegrityError as e:
+                Burial.report_save_error(e)
+            except:
+                Burial.report_save_error(sys.exc_info()[1])
             else:
-                burial.confidence_level = 1
+                Burial.next_card(values)
+            return
+        Burial.default_plot = record['plot']
+        if EntryClient.connection is not None:
+            # Saved by the entry server, which sends back the new counts and defaults
+            try:
+                EntryClient.save(record)
+            except EntryError as e:
+                Burial.report_save_error(e)
+            except OSError as e:
+                sg.popup_error(e, 'The card was not saved')
+            else:
+                Burial.next_card(values)
+            return
+        if BurialWriter.thread is not None:
+            # Written in the background, a failure comes back through BurialWriter.failures
+            BurialWriter.put(record)
+            BurialStats.update(record)
+            Burial.next_card(values)
+            return
+        try:
+            Burial.save_record(sql_session, record)
+        except IntegrityError as e:
+            Burial.report_save_error(e)
+        except:
+            Burial.report_save_error(sys.exc_info()[1])
         else:
-            burial.confidence_level = 0
+            Burial.next_card(values)
 
+    # Commit one record in its own transaction, any error is left to the caller
+    def save_record(sql_session, record):
+        burial = Burial(**record)
+        told = False
         try:
             with sql_session.begin():
                 sql_session.add(burial)
-                Burial.default_plot = burial.plot
-        except IntegrityError as e:
+                sql_session.flush()
+                GraveIndex.add(burial.id, record)
+                told = True
+        except:
+            if told:
+                GraveIndex.change(burial.id, record, None)
+            raise
+        BurialStats.update(record)
+        Completer.add(record)
+
+    # Replace a card already entered. Edits can lower the aggregates so they are read again
+    def update_record(sql_session, id, record):
+        BurialWriter.flush()
+        told = False
+        try:
+            with sql_session.begin():
+                old = dict(sql_session.execute(select(Burial.__table__).where(Burial.id == id)).mappings().one())
+                sql_session.execute(update(Burial.__table__).where(Burial.id == id).values(**record))
+                GraveIndex.change(id, old, record)
+                told = True
+        except:
+            if told:
+                GraveIndex.change(id, record, old)
+            raise
+        BurialStats.load(sql_session)
+        Completer.add(record, old)
+
+    def report_save_error(e):
+        if isinstance(e, IntegrityError) or isinstance(e, EntryError) and e.integrity:
             if str(e.orig).startswith('UNIQUE constraint failed'):
                 m = str(e.orig).split(':')
                 if m[1] == ' burial.source_document_ref':
@@ -276,185 +615,1724 @@ class Burial(Base):
                     sg.popup(e.orig, 'The data could not be saved because of the above error')
             else:
                 sg.popup(e.orig, 'The data could not be saved because of the above error')
-        except:
-            e = sys.exc_info()[0]
-            sg.popup_error(e, 'Please report this error to the software developer')
+        elif isinstance(e, EntryError):
+            sg.popup(e.orig, 'The data could not be saved because of the above error')
         else:
-            Burial.gui_layout_new_record()
+            sg.popup_error(type(e), 'Please report this error to the software developer')
 
-if __name__ == '__main__':
-    def create_db(sql_session):
+    # Load a card already entered into the form, saving it then updates the card
+    def edit(record):
+        Burial.gui_layout_restore(record)
+        Burial.editing = record['id']
+        Burial.set_state('Save', text = 'Update')
+        Burial.set_state(Burial.records_entered.key, value = 'Editing card ' + str(record['id']))
+
+    # After a card is saved or cleared the form shows the next card not saved, or a new card
+    def next_card(values):
+        if Burial.unsaved:
+            Burial.gui_layout_restore(Burial.unsaved.pop(0))
+        else:
+            Burial.gui_layout_new_record(values)
+        Burial.show_unsaved()
+
+    # Keep cards the background writer could not save until the form is free for them.
+    # The form is only taken over when no names have been typed, so a card being
+    # entered is never lost
+    def add_unsaved(records, values):
+        Burial.unsaved.extend(records)
+        if Burial.editing is None and not values['-given_names-'].strip() and not values['-family_name-'].strip():
+            Burial.gui_layout_restore(Burial.unsaved.pop(0))
+        Burial.show_unsaved()
+
+    def show_unsaved():
+        Burial.set_state('-unsaved-', value = 'Unsaved cards: ' + str(len(Burial.unsaved)) if Burial.unsaved else '')
+
+    # Put a record that could not be saved back into the form so it can be corrected
+    def gui_layout_restore(record):
+        Burial.gui_layout_new_record()
+        values = Burial.record_to_values(record)
+        for key, value in values.items():
+            Burial.elements[key].update(value = value)
+        Burial.reset_completion(values)
+        Burial.update_age_states(values)
+        Burial.show_grave(values)
+        Burial.set_state('Save', disabled = False)
+
+    # The form values that show a burial record
+    def record_to_values(record):
+        values = {}
+        for field in FIELDS:
+            value = record[field.name]
+            if field.kind == 'checkbox':
+                values[field.key] = bool(value)
+            elif field.kind == 'confidence':
+                values[field.key] = Burial.confidence_names.get(value, 'High')
+            elif value is None:
+                values[field.key] = ''
+            else:
+                values[field.key] = str(value)
+
+        return values
+
+# Opt-in timing of the event loop and of every SQL statement. Each timed
+# name keeps its last window durations so the percentiles follow recent use.
+# Nothing is hooked in unless enabled, leaving one flag test per event.
+class Instrumentation:
+    enabled = False
+    window = 1000
+    samples = {}
+    lock = threading.Lock()
+
+    def enable(sql_engine):
+        Instrumentation.enabled = True
+        event.listen(sql_engine, 'before_cursor_execute', Instrumentation.before_cursor_execute)
+        event.listen(sql_engine, 'after_cursor_execute', Instrumentation.after_cursor_execute)
+        event.listen(sql_engine, 'handle_error', Instrumentation.handle_error)
+
+    # Statements are also timed on the writer and duplicate lookup threads
+    def record(name, seconds):
+        with Instrumentation.lock:
+            samples = Instrumentation.samples.get(name)
+            if samples is None:
+                samples = Instrumentation.samples[name] = collections.deque(maxlen = Instrumentation.window)
+            samples.append(seconds)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['statement_started'].pop()
+        Instrumentation.record('sql ' + ' '.join(statement.split())[:120], time.perf_counter() - started)
+
+    # A failed statement gets no after_cursor_execute, its start is dropped here so
+    # the next statement on the connection is not timed from it
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('statement_started'):
+            context.connection.info['statement_started'].pop()
+
+    # Count, percentiles and worst case in milliseconds for each name, slowest in total first
+    def report():
+        with Instrumentation.lock:
+            snapshot = [(name, sorted(samples)) for name, samples in Instrumentation.samples.items()]
+        rows = []
+        for name, times in snapshot:
+            rows.append({'name': name,
+                         'count': len(times),
+                         'total_ms': sum(times) * 1000,
+                         'p50_ms': times[len(times) // 2] * 1000,
+                         'p90_ms': times[min(len(times) - 1, len(times) * 9 // 10)] * 1000,
+                         'p99_ms': times[min(len(times) - 1, len(times) * 99 // 100)] * 1000,
+                         'max_ms': times[-1] * 1000})
+        rows.sort(key = lambda row: row['total_ms'], reverse = True)
+
+        return rows
+
+    def dump(path):
+        with open(path, 'w') as f:
+            json.dump({'version': VERSION, 'window': Instrumentation.window, 'timings': Instrumentation.report()}, f, indent = 2)
+
+    def gui_window():
+        rows = [[row['name'], row['count'], '%.2f' % row['p50_ms'], '%.2f' % row['p90_ms'],
+                 '%.2f' % row['p99_ms'], '%.2f' % row['max_ms']] for row in Instrumentation.report()]
+        layout = [[sg.Table(rows, headings = ['Event or statement', 'Count', 'p50 ms', 'p90 ms', 'p99 ms', 'Max ms'],
+                            auto_size_columns = False, col_widths = [60, 7, 8, 8, 8, 8], justification = 'right',
+                            num_rows = min(25, max(len(rows), 1)), font = ('Courier', 10))],
+                  [sg.Button('Close')]]
+        window = sg.Window('Diagnostics', layout, modal = True)
+        window.read()
+        window.close()
+
+# Saves burial records on a background thread so the form never waits for a
+# commit. Records queued while a transaction is being written are committed
+# together as one group, each in its own savepoint so a rejected record does
+# not take the rest of the group with it. Rejected records are put on
+# failures as (record, exception) and notify is called to wake the GUI.
+class BurialWriter:
+    group_size = 100
+    pending = None
+    failures = None
+    notify = None
+    thread = None
+
+    def start(sql_engine, notify = None):
+        BurialWriter.pending = queue.Queue()
+        BurialWriter.failures = queue.Queue()
+        BurialWriter.notify = notify
+        BurialWriter.thread = threading.Thread(target = BurialWriter.run, args = (sql_engine,), name = 'BurialWriter', daemon = True)
+        BurialWriter.thread.start()
+
+    # done(id, error), when given, is called from the writer thread once the record has
+    # been committed or rejected, and a rejected record is then not added to failures
+    def put(record, done = None):
+        BurialWriter.pending.put((record, done))
+
+    # Wait until everything queued so far has been committed or rejected
+    def flush():
+        if BurialWriter.thread is not None:
+            BurialWriter.pending.join()
+
+    # Write out anything still queued and stop the thread
+    def stop():
+        if BurialWriter.thread is not None:
+            BurialWriter.pending.put(None)
+            BurialWriter.thread.join()
+            BurialWriter.thread = None
+
+    def take_failures():
+        failures = []
+        while not BurialWriter.failures.empty():
+            failures.append(BurialWriter.failures.get())
+
+        return failures
+
+    def run(sql_engine):
+        writer_session = Session(sql_engine)
+        stopping = False
+        while not stopping:
+            items = [BurialWriter.pending.get()]
+            while len(items) < BurialWriter.group_size:
+                try:
+                    items.append(BurialWriter.pending.get_nowait())
+                except queue.Empty:
+                    break
+            records = [item for item in items if item is not None]
+            stopping = len(records) < len(items)
+            failures = []
+            saved = []
+            try:
+                with writer_session.begin():
+                    for record, done in records:
+                        try:
+                            with writer_session.begin_nested():
+                                result = writer_session.execute(Burial.__table__.insert(), record)
+                            saved.append((result.inserted_primary_key[0], record, done))
+                            GraveIndex.add(result.inserted_primary_key[0], record)
+                        except IntegrityError as e:
+                            failures.append((record, done, e))
+            except Exception as e:
+                # The commit itself failed so nothing in the group was saved
+                for id, record, done in saved:
+                    GraveIndex.change(id, record, None)
+                failures = [(record, done, e) for record, done in records]
+                saved = []
+            for id, record, done in saved:
+                Completer.add(record)
+                if done is not None:
+                    BurialWriter.report(done, id, None)
+            reported = False
+            for record, done, e in failures:
+                if done is not None:
+                    BurialWriter.report(done, None, e)
+                else:
+                    BurialWriter.failures.put((record, e))
+                    reported = True
+            if reported and BurialWriter.notify is not None and not stopping:
+                BurialWriter.notify()
+            for item in items:
+                BurialWriter.pending.task_done()
+        writer_session.close()
+
+    # A done callback that fails is logged, it must not stop the writer the other cards are waiting on
+    def report(done, id, e):
+        try:
+            done(id, e)
+        except Exception:
+            print('Reporting a saved card failed', file = sys.stderr)
+            traceback.print_exc()
+
+# Running aggregates used to refresh the entry form after each save. They are
+# loaded from the database once at startup and then kept up to date from each
+# committed record, so the refresh does not have to scan the burial table.
+class BurialStats:
+    row_count = 0
+    date_of_birth = None
+    date_of_death = None
+    date_of_burial = None
+    source_document_ref = None
+    page_number = None
+
+    # Aggregate the whole burial table, this is the query the cache replaces.
+    # Each aggregate is its own subquery so SQLite can answer the min/max from
+    # the column indexes instead of scanning the table
+    def query(sql_session):
+        stmt = select(select(func.count()).select_from(Burial).scalar_subquery().label('row_count'),
+                      select(func.min(Burial.date_of_birth)).scalar_subquery().label('date_of_birth'),
+                      select(func.max(Burial.date_of_death)).scalar_subquery().label('date_of_death'),
+                      select(func.max(Burial.date_of_burial)).scalar_subquery().label('date_of_burial'),
+                      select(func.max(Burial.source_document_ref)).scalar_subquery().label('source_document_ref'),
+                      select(func.max(Burial.page_number)).scalar_subquery().label('page_number'))
+        with sql_session.begin():
+            r = sql_session.execute(stmt).one()
+            return {'row_count': r['row_count'],
+                    'date_of_birth': r['date_of_birth'],
+                    'date_of_death': r['date_of_death'],
+                    'date_of_burial': r['date_of_burial'],
+                    'source_document_ref': r['source_document_ref'],
+                    'page_number': r['page_number']}
+
+    def load(sql_session):
+        for name, value in BurialStats.query(sql_session).items():
+            setattr(BurialStats, name, value)
+
+    # Fold a newly committed record into the aggregates
+    def update(record):
+        BurialStats.row_count += 1
+        if record['date_of_birth'] and (BurialStats.date_of_birth is None or record['date_of_birth'] < BurialStats.date_of_birth):
+            BurialStats.date_of_birth = record['date_of_birth']
+        if record['date_of_death'] and (BurialStats.date_of_death is None or record['date_of_death'] > BurialStats.date_of_death):
+            BurialStats.date_of_death = record['date_of_death']
+        if record['date_of_burial'] and (BurialStats.date_of_burial is None or record['date_of_burial'] > BurialStats.date_of_burial):
+            BurialStats.date_of_burial = record['date_of_burial']
+        source_document_ref = BurialStats.as_number(record['source_document_ref'])
+        if source_document_ref is not None and (BurialStats.source_document_ref is None or source_document_ref > BurialStats.source_document_ref):
+            BurialStats.source_document_ref = source_document_ref
+        page_number = BurialStats.as_number(record['page_number'])
+        if page_number is not None and (BurialStats.page_number is None or page_number > BurialStats.page_number):
+            BurialStats.page_number = page_number
+
+    # The form holds numbers as text, store them the way SQLite's integer affinity would
+    def as_number(value):
+        if value is None or value == '':
+            return None
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        if number.is_integer():
+            return int(number)
+        return number
+
+    # Compare the cached aggregates with the database, returning a list of
+    # (name, cached, actual) for every value that differs
+    def verify(sql_session):
+        mismatches = []
+        for name, value in BurialStats.query(sql_session).items():
+            if getattr(BurialStats, name) != value:
+                mismatches.append((name, getattr(BurialStats, name), value))
+
+        return mismatches
+
+# Who is already buried in each grave, keyed by (plot, row, number) compared
+# without case or surrounding spaces. The index is built from the burial table
+# on a background thread at startup and then updated from each committed card,
+# so finding the occupants of the grave being typed is a dictionary lookup.
+# Ashes do not count towards a grave being full.
+class GraveIndex:
+    capacity = 3
+
+    graves = None
+    coffins = None
+    plots = None
+    pending = None
+    building = None
+    scanned = 0
+    changed = None
+    chunk = 10000
+    lock = threading.Lock()
+    notify = None
+    thread = None
+
+    def key(plot, plot_row, plot_row_number):
+        key = tuple((part or '').strip().casefold() for part in (plot, plot_row, plot_row_number))
+        if not all(key):
+            return None
+        return key
+
+    def plot_key(plot):
+        return (plot or '').strip().casefold() or None
+
+    # notify() is called from the building thread once lookups can be made
+    def start(sql_engine, notify = None, capacity = None):
+        if capacity is not None:
+            GraveIndex.capacity = capacity
+        GraveIndex.graves = None
+        GraveIndex.pending = []
+        GraveIndex.notify = notify
+        GraveIndex.thread = threading.Thread(target = GraveIndex.build, args = (sql_engine,), name = 'GraveIndex', daemon = True)
+        GraveIndex.thread.start()
+
+    def build(sql_engine):
+        graves = {}
+        coffins = {}
+        plots = {}
+        with GraveIndex.lock:
+            GraveIndex.building = (graves, coffins, plots)
+            GraveIndex.scanned = 0
+            GraveIndex.changed = set(id for id, old, new in GraveIndex.pending)
+        index_session = Session(sql_engine)
+        columns = (Burial.id, Burial.plot, Burial.plot_row, Burial.plot_row_number, Burial.ashes)
+        last_id = 0
+        while True:
+            # Each chunk is read in its own short transaction, one long read would hold saves up until it was done
+            with index_session.begin():
+                rows = index_session.execute(select(*columns).where(Burial.plot != None, Burial.id > last_id)
+                                             .order_by(Burial.id).limit(GraveIndex.chunk)).all()
+            with GraveIndex.lock:
+                for id, plot, plot_row, plot_row_number, ashes in rows:
+                    # A card changed during the build is put in as last committed once the scan is done
+                    if id not in GraveIndex.changed:
+                        GraveIndex.insert(graves, coffins, plots, id, plot, plot_row, plot_row_number, ashes)
+                if rows:
+                    GraveIndex.scanned = rows[-1][0]
+            if len(rows) < GraveIndex.chunk:
+                break
+            last_id = rows[-1][0]
+        index_session.close()
+        with GraveIndex.lock:
+            latest = {}
+            for id, old, new in GraveIndex.pending:
+                latest[id] = new
+            for id, new in latest.items():
+                if new is not None:
+                    GraveIndex.insert(graves, coffins, plots, id, new['plot'], new['plot_row'], new['plot_row_number'], new['ashes'])
+            GraveIndex.graves = graves
+            GraveIndex.coffins = coffins
+            GraveIndex.plots = plots
+            GraveIndex.pending = None
+            GraveIndex.building = None
+            GraveIndex.changed = None
+        if GraveIndex.notify is not None:
+            GraveIndex.notify()
+
+    def insert(graves, coffins, plots, id, plot, plot_row, plot_row_number, ashes):
+        plot_key = GraveIndex.plot_key(plot)
+        if plot_key is None:
+            return
+        counts = plots.setdefault(plot_key, [0, 0])
+        counts[0] += 1
+        key = GraveIndex.key(plot, plot_row, plot_row_number)
+        if key is None:
+            return
+        if key not in graves:
+            graves[key] = []
+            coffins[key] = 0
+            counts[1] += 1
+        graves[key].append(id)
+        if not ashes:
+            coffins[key] += 1
+
+    def delete(graves, coffins, plots, id, plot, plot_row, plot_row_number, ashes):
+        plot_key = GraveIndex.plot_key(plot)
+        if plot_key not in plots:
+            return
+        counts = plots[plot_key]
+        counts[0] -= 1
+        key = GraveIndex.key(plot, plot_row, plot_row_number)
+        if key in graves and id in graves[key]:
+            graves[key].remove(id)
+            if not ashes:
+                coffins[key] -= 1
+            if not graves[key]:
+                del graves[key]
+                del coffins[key]
+                counts[1] -= 1
+        if counts[0] <= 0:
+            del plots[plot_key]
+
+    # Fold in a new card, or a card changed from old to new, safe to call from any thread. Cards
+    # are folded in before they are committed, so a build reading the table a chunk at a time
+    # either reads a card after being told of its change or read it before the change was made.
+    # A change whose commit fails is taken back with the change the other way
+    def add(id, record):
+        GraveIndex.change(id, None, record)
+
+    def change(id, old, new):
+        with GraveIndex.lock:
+            if GraveIndex.pending is not None:
+                if GraveIndex.building is not None and id <= GraveIndex.scanned and id not in GraveIndex.changed:
+                    # The build has already read the card as it was before
+                    GraveIndex.apply(GraveIndex.building, id, old, new)
+                else:
+                    GraveIndex.pending.append((id, old, new))
+                    if GraveIndex.changed is not None:
+                        GraveIndex.changed.add(id)
+            elif GraveIndex.graves is not None:
+                GraveIndex.apply((GraveIndex.graves, GraveIndex.coffins, GraveIndex.plots), id, old, new)
+
+    def apply(index, id, old, new):
+        if old is not None:
+            GraveIndex.delete(*index, id, old['plot'], old['plot_row'], old['plot_row_number'], old['ashes'])
+        if new is not None:
+            GraveIndex.insert(*index, id, new['plot'], new['plot_row'], new['plot_row_number'], new['ashes'])
+
+    # The ids buried in a grave and how many were coffins, or None until the index is built
+    def occupants(plot, plot_row, plot_row_number):
+        with GraveIndex.lock:
+            if GraveIndex.graves is None:
+                return None
+            key = GraveIndex.key(plot, plot_row, plot_row_number)
+            if key is None:
+                return [], 0
+            return list(GraveIndex.graves.get(key, ())), GraveIndex.coffins.get(key, 0)
+
+    # (burials, graves) in a plot, or None until the index is built
+    def plot_counts(plot):
+        with GraveIndex.lock:
+            if GraveIndex.plots is None:
+                return None
+            return tuple(GraveIndex.plots.get(GraveIndex.plot_key(plot), (0, 0)))
+
+    def likely_full(coffins):
+        return coffins >= GraveIndex.capacity
+
+# Completions for the fields typed most often, the commonest values first.
+# Each field has a trie of its values compared without case, and every node
+# keeps the few most frequent values below it so a lookup only walks the
+# prefix. The tries are built on a background thread from the commonest
+# capacity values of each field, which bounds their size however large the
+# database, and cards committed afterwards are counted in as they are saved.
+class Completer:
+    fields = ('family_name', 'given_names', 'plot', 'plot_row')
+    capacity = 10000
+    shown = 5
+
+    # Per field, value counts and the trie. A node is [children by character, top values, value ending here]
+    counts = {}
+    tries = {}
+    lock = threading.Lock()
+    thread = None
+
+    def start(sql_engine, capacity = None):
+        if capacity is not None:
+            Completer.capacity = capacity
+        Completer.counts = {}
+        Completer.tries = {}
+        Completer.thread = threading.Thread(target = Completer.build, args = (sql_engine,), name = 'Completer', daemon = True)
+        Completer.thread.start()
+
+    def build(sql_engine):
+        build_session = Session(sql_engine)
+        for name in Completer.fields:
+            column = Burial.__table__.c[name]
+            with build_session.begin():
+                rows = build_session.execute(select(column, func.count())
+                                             .where(column != None)
+                                             .group_by(column)
+                                             .order_by(func.count().desc())
+                                             .limit(Completer.capacity)).all()
+            counts = {}
+            root = [{}, [], None]
+            for value, count in rows:
+                value = value.strip()
+                if value:
+                    counts[value] = counts.get(value, 0) + count
+            for value, count in counts.items():
+                Completer.insert(root, counts, value)
+            with Completer.lock:
+                # Cards saved before the field was first built are only counted so far, those saved
+                # while it was being read are counted twice which only shifts the ranking a little
+                pending = Completer.counts.get(name, {}) if name not in Completer.tries else {}
+                for value, count in pending.items():
+                    if value in counts or len(counts) < Completer.capacity:
+                        counts[value] = counts.get(value, 0) + count
+                        Completer.insert(root, counts, value)
+                Completer.counts[name] = counts
+                Completer.tries[name] = root
+        build_session.close()
+
+    # Put value on its path, or move it up the nodes' top values after its count went up
+    def insert(root, counts, value):
+        node = root
+        path = [root]
+        for character in value.casefold():
+            node = node[0].setdefault(character, [{}, [], None])
+            path.append(node)
+        node[2] = value
+        count = counts[value]
+        for node in path[1:]:
+            top = node[1]
+            if value in top:
+                top.remove(value)
+            elif len(top) >= Completer.shown and counts[top[-1]] >= count:
+                continue
+            n = 0
+            while n < len(top) and counts[top[n]] >= count:
+                n += 1
+            top.insert(n, value)
+            del top[Completer.shown:]
+
+    # After a count has gone down the top values below each node on its path are found again
+    def refresh(root, counts, value):
+        node = root
+        path = []
+        for character in value.casefold():
+            node = node[0].get(character)
+            if node is None:
+                return
+            path.append(node)
+        for node in path:
+            if value not in node[1]:
+                continue
+            values = []
+            stack = [node]
+            while stack:
+                below = stack.pop()
+                if below[2] is not None and counts.get(below[2], 0) > 0:
+                    values.append(below[2])
+                stack.extend(below[0].values())
+            values.sort(key = lambda value: counts[value], reverse = True)
+            node[1] = values[:Completer.shown]
+
+    # Count in a committed card, and take out the card it replaced if it was edited
+    def add(record, old = None):
+        with Completer.lock:
+            for name in Completer.fields:
+                counts = Completer.counts.setdefault(name, {})
+                root = Completer.tries.get(name)
+                if old is not None and old[name] and old[name].strip() in counts:
+                    value = old[name].strip()
+                    counts[value] -= 1
+                    if root is not None:
+                        Completer.refresh(root, counts, value)
+                value = (record[name] or '').strip()
+                if value and (value in counts or len(counts) < Completer.capacity):
+                    counts[value] = counts.get(value, 0) + 1
+                    if root is not None:
+                        Completer.insert(root, counts, value)
+
+    # The commonest values starting with prefix, any case
+    def suggestions(name, prefix):
+        with Completer.lock:
+            node = Completer.tries.get(name)
+            if node is None or not prefix:
+                return []
+            for character in prefix.casefold():
+                node = node[0].get(character)
+                if node is None:
+                    return []
+            return list(node[1])
+
+    # The commonest value longer than prefix that starts with it, or None
+    def complete(name, prefix):
+        for value in Completer.suggestions(name, prefix):
+            if len(value) > len(prefix):
+                return value
+        return None
+
+# Backs the database up while cards are being entered. The first snapshot is a
+# full copy made with SQLite's online backup API a few pages at a time, pausing
+# between steps so saves are never held up for long. After that a snapshot only
+# appends the burial_journal rows written since the last one to journal.db in
+# the backup directory, so it costs about as much as the edits made since.
+# backup_cards.py restores a copy and replays the journal up to a point in time
+class Snapshotter:
+    pages = 256
+    pause = 0.01
+    restarts = 20
+    interval = 600
+    directory = None
+    db_path = None
+    notify = None
+    stopping = None
+    thread = None
+
+    def start(db_path, directory = None, interval = None, notify = None):
+        if interval is not None:
+            Snapshotter.interval = interval
+        Snapshotter.db_path = db_path
+        Snapshotter.directory = directory or Snapshotter.default_directory(db_path)
+        Snapshotter.notify = notify
+        Snapshotter.stopping = threading.Event()
+        Snapshotter.thread = threading.Thread(target = Snapshotter.run, name = 'Snapshotter', daemon = True)
+        Snapshotter.thread.start()
+
+    # Take a last snapshot of what was saved since the one before and stop. The
+    # window may already be closed so a failure then is not reported
+    def stop():
+        if Snapshotter.thread is not None:
+            Snapshotter.notify = None
+            Snapshotter.stopping.set()
+            Snapshotter.thread.join()
+            Snapshotter.thread = None
+
+    def default_directory(db_path):
+        return os.path.splitext(db_path)[0] + '_backups'
+
+    def run():
+        failed = False
+        while True:
+            try:
+                Snapshotter.snapshot(Snapshotter.db_path, Snapshotter.directory)
+                failed = False
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                # Reported once rather than every time it fails again
+                if not failed and Snapshotter.notify is not None:
+                    Snapshotter.notify(str(e))
+                failed = True
+            if Snapshotter.stopping.is_set():
+                break
+            Snapshotter.stopping.wait(Snapshotter.interval)
+
+    # The full copies in directory as (seq, path), oldest first. seq is the last
+    # journal row each one includes
+    def bases(directory):
+        bases = []
+        for name in os.listdir(directory) if os.path.isdir(directory) else ():
+            match = re.fullmatch(r'base-(\d+)\.db', name)
+            if match:
+                bases.append((int(match.group(1)), os.path.join(directory, name)))
+
+        return sorted(bases)
+
+    # Back db_path up to directory, making a full copy when there is none yet or
+    # full is set. Returns the seq of the new full copy, or None, and the number
+    # of journal rows copied
+    def snapshot(db_path, directory, full = False):
+        os.makedirs(directory, exist_ok = True)
+        source = sqlite3.connect(db_path, timeout = 30, isolation_level = None)
+        try:
+            base = None
+            if full or not Snapshotter.bases(directory) or Snapshotter.missed_changes(source, directory):
+                base = Snapshotter.copy_base(source, directory)
+            copied = Snapshotter.copy_journal(source, directory)
+        finally:
+            source.close()
+
+        return base, copied
+
+    # True when journal rows not yet in journal.db were removed without being backed up, as
+    # they are while backups are off, so only a new full copy has their changes
+    def missed_changes(source, directory):
+        copied_seq = 0
+        journal_path = os.path.join(directory, 'journal.db')
+        if os.path.exists(journal_path):
+            journal = sqlite3.connect(journal_path)
+            try:
+                if journal.execute("select 1 from sqlite_master where name = 'sqlite_sequence'").fetchone():
+                    copied_seq = Snapshotter.last_seq(journal, 'main')
+            finally:
+                journal.close()
+        waiting = source.execute('select count(*) from burial_journal where seq > ?', (copied_seq,)).fetchone()[0]
+
+        return waiting < Snapshotter.last_seq(source, 'main') - copied_seq
+
+    def copy_base(source, directory):
+        partial = os.path.join(directory, 'base.partial')
+        # Including the journal a copy that failed may have left, or it would be rolled back into this one
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(partial + suffix):
+                os.remove(partial + suffix)
+        # A save from another connection starts the copy again. With a write ahead log a read
+        # transaction keeps the copy to one version of the database while saves carry on, without
+        # one it would hold saves up until the copy was done so the copy is started again instead
+        wal = source.execute('pragma journal_mode').fetchone()[0] == 'wal'
+        restarts = [0, None]
+        def progress(status, remaining, total):
+            if restarts[1] is not None and remaining >= restarts[1]:
+                restarts[0] += 1
+                if restarts[0] > Snapshotter.restarts:
+                    raise RuntimeError('The database changed too often to be copied, the wal storage profile avoids this')
+            restarts[1] = remaining
+            time.sleep(Snapshotter.pause)
+
+        target = sqlite3.connect(partial)
+        try:
+            if wal:
+                source.execute('begin')
+                source.execute('select count(*) from sqlite_master').fetchone()
+            try:
+                source.backup(target, pages = Snapshotter.pages, progress = progress)
+            finally:
+                if wal:
+                    source.execute('commit')
+            seq = Snapshotter.last_seq(target, 'main')
+        finally:
+            target.close()
+        os.replace(partial, os.path.join(directory, 'base-%010d.db' % seq))
+
+        return seq
+
+    # The last journal seq handed out, which rows removed from the journal do not change
+    def last_seq(connection, schema):
+        row = connection.execute('select seq from ' + schema + ".sqlite_sequence where name = 'burial_journal'").fetchone()
+
+        return row[0] if row else 0
+
+    def copy_journal(source, directory):
+        source.execute('attach database ? as backup', (os.path.join(directory, 'journal.db'),))
+        try:
+            source.execute('begin')
+            try:
+                source.execute(JOURNAL_TABLE.format(schema = 'backup.'))
+                copied_seq = Snapshotter.last_seq(source, 'backup')
+                if Snapshotter.last_seq(source, 'main') < copied_seq:
+                    raise RuntimeError('The database is older than its backups in ' + directory +
+                                       ', it must be backed up to a new directory')
+                copied = source.execute('insert into backup.burial_journal select * from main.burial_journal where seq > ?', (copied_seq,)).rowcount
+                source.execute('commit')
+            except:
+                source.execute('rollback')
+                raise
+            # Once in journal.db the rows are no longer needed in the database
+            source.execute('delete from main.burial_journal where seq <= ?', (Snapshotter.last_seq(source, 'backup'),))
+        finally:
+            source.execute('detach database backup')
+
+        return copied
+
+# Looks for cards already entered that are probably the one being typed.
+# Names are searched through burial_name, an FTS5 trigram index that triggers
+# keep in step with burial, and the candidates are scored on how alike the
+# names are and on whether the dates or plot agree. The form runs lookups on a
+# background thread once typing has paused for delay seconds, so a keystroke
+# only costs handing the latest names to that thread.
+class DuplicateFinder:
+    fields = ('given_names', 'family_name', 'date_of_birth', 'date_of_death', 'date_of_burial', 'plot')
+    delay = 0.3
+    candidates = 50
+    shown = 5
+    threshold = 0.7
+    search_table = table('burial_name_search', column('rowid'), column('burial_name_search'))
+
+    condition = None
+    card = None
+    requested = 0
+    generation = 0
+    stopping = False
+    notify = None
+    thread = None
+
+    # FTS5's trigram tokenizer arrived in SQLite 3.34, older libraries look
+    # names up through the burial_name index on (family_name, given_names) instead
+    def can_index(sql_session):
+        if sqlite3.sqlite_version_info < (3, 34, 0):
+            return False
+        return bool(sql_session.execute("select sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+    def create_index(sql_session):
+        if not DuplicateFinder.can_index(sql_session):
+            return
+        sql_session.execute('''create virtual table if not exists burial_name_search using fts5 (
+                               given_names, family_name,
+                               content = 'burial', content_rowid = 'id', tokenize = 'trigram'
+                               )''')
+        sql_session.execute('''create trigger if not exists burial_name_search_insert after insert on burial begin
+                               insert into burial_name_search (rowid, given_names, family_name)
+                               values (new.id, new.given_names, new.family_name);
+                               end''')
+        sql_session.execute('''create trigger if not exists burial_name_search_delete after delete on burial begin
+                               insert into burial_name_search (burial_name_search, rowid, given_names, family_name)
+                               values ('delete', old.id, old.given_names, old.family_name);
+                               end''')
+        sql_session.execute('''create trigger if not exists burial_name_search_update after update of given_names, family_name on burial begin
+                               insert into burial_name_search (burial_name_search, rowid, given_names, family_name)
+                               values ('delete', old.id, old.given_names, old.family_name);
+                               insert into burial_name_search (rowid, given_names, family_name)
+                               values (new.id, new.given_names, new.family_name);
+                               end''')
+        sql_session.execute("insert into burial_name_search (burial_name_search) values ('rebuild')")
+
+    def has_index(sql_session):
         with sql_session.begin():
-            sql_session.execute('''create table burial (
-                                   id integer primary key,
-                                   given_names varchar(256) not null,
-                                   family_name varchar(256) not null,
-                                   date_of_birth varchar(32),
-                                   date_of_death varchar(32),
-                                   date_of_burial varchar(32),
-                                   ashes integer,
-                                   age_years integer,
-                                   age_months integer,
-                                   age_days integer,
-                                   stillborn integer,
-                                   source_document_ref integer unique,
-                                   cross_reference integer,
-                                   page_number integer,
-                                   see_page_number varchar(256),
-                                   plot varchar(32),
-                                   plot_row varchar(32),
-                                   plot_row_number varchar(32),
-                                   notes text,
-                                   confidence_level integer
-                                   )''')
-            sql_session.execute('''create table config (
-                                   id integer primary key,
-                                   domain varchar(256) not null,
-                                   name varchar(256) not null,
-                                   value varchar(256)
-                                   )''')
-
-    def add_created_by(sql_session):
+            return sql_session.execute("select count(*) from sqlite_master where name = 'burial_name_search'").scalar() > 0
+
+    # The V1.09 migration leaves the index out when SQLite cannot make it, it is
+    # made when the database is next opened by a SQLite that can
+    def add_missing_index(sql_session):
+        if DuplicateFinder.has_index(sql_session):
+            return
         with sql_session.begin():
-            config = Config()
-            config.domain = 'Database'
-            config.name = 'CreatedBy'
-            config.value = 'log.py ' + VERSION
-            sql_session.add(config)
-            config = Config()
-            config.domain = 'Database'
-            config.name = 'Version'
-            config.value = VERSION
-            sql_session.add(config)
+            if DuplicateFinder.can_index(sql_session):
+                DuplicateFinder.create_index(sql_session)
 
-    def get_config_value(sql_session, domain, name):
-        return Config.get_value(sql_session, domain, name)
+    def phrase(text):
+        return '"' + text.replace('"', '""') + '"'
 
-    def get_source_document(sql_session):
-        return get_config_value(sql_session, 'Source', 'DocumentName')
+    # Candidate records for a card, newest first. The names must contain what
+    # has been typed, and when that finds too few the family name need only
+    # share a trigram with the one typed, so misspellings still turn up
+    def candidates_for(sql_session, card, indexed):
+        family_name = (card['family_name'] or '').strip()
+        given_name = (card['given_names'] or '').strip().split(' ')[0]
+        if len(family_name) < 3:
+            return []
+        if not indexed:
+            stmt = select(Burial).where(Burial.family_name == family_name).order_by(desc(Burial.id)).limit(DuplicateFinder.candidates)
+            with sql_session.begin():
+                return sql_session.execute(stmt).scalars().all()
 
-    def create_source_document(sql_session):
-        source_doc = sg.popup_get_text('Enter the source document name')
-        if source_doc is None or source_doc.rstrip() == '':
-            sg.popup('A source document name is required before data can be entered')
-            exit()
+        queries = []
+        if len(given_name) >= 3:
+            queries.append('family_name : ' + DuplicateFinder.phrase(family_name) + ' AND given_names : ' + DuplicateFinder.phrase(given_name))
+            if len(family_name) >= 4:
+                trigrams = sorted(set(family_name[i:i + 3] for i in range(len(family_name) - 2)))
+                queries.append('given_names : ' + DuplicateFinder.phrase(given_name) +
+                               ' AND family_name : (' + ' OR '.join(DuplicateFinder.phrase(t) for t in trigrams) + ')')
+        else:
+            queries.append('family_name : ' + DuplicateFinder.phrase(family_name))
+
+        found = {}
         with sql_session.begin():
-            config = Config()
-            config.domain = 'Source'
-            config.name = 'DocumentName'
-            config.value = source_doc
-            sql_session.add(config)
+            for query in queries:
+                stmt = (select(Burial)
+                        .join(DuplicateFinder.search_table, DuplicateFinder.search_table.c.rowid == Burial.id)
+                        .where(DuplicateFinder.search_table.c.burial_name_search.op('match')(query))
+                        .order_by(desc(DuplicateFinder.search_table.c.rowid))
+                        .limit(DuplicateFinder.candidates))
+                for burial in sql_session.execute(stmt).scalars():
+                    found[burial.id] = burial
+                if len(found) >= DuplicateFinder.shown:
+                    break
 
-        return get_source_document(sql_session)
+        return list(found.values())
 
-    def get_plot_default(sql_session):
-        # Get the last entered burial record with a non-null plot and use the plot as a default
-        return Burial.get_last_plot(sql_session)
+    def similarity(a, b):
+        return difflib.SequenceMatcher(None, (a or '').lower(), (b or '').lower()).ratio()
 
-    def any_age_given(window):
-        return window['-age_years-'].get() != '' or window['-age_months-'].get() != '' or window['-age_days-'].get() != ''
+    def close_dates(a, b):
+        try:
+            return abs((datetime.date.fromisoformat(a) - datetime.date.fromisoformat(b)).days) <= 366
+        except (TypeError, ValueError):
+            return False
 
-    def validate_age(window, values, id):
-        value = values[id]
-        for ndx in range(len(value)):
-            if value[ndx] not in '0123456789':
-                value = value[:ndx]
-                window[id].update(value)
+    def score(card, burial):
+        if card['given_names']:
+            score = 0.6 * DuplicateFinder.similarity(card['family_name'], burial.family_name) + \
+                    0.4 * DuplicateFinder.similarity(card['given_names'], burial.given_names)
+        else:
+            score = DuplicateFinder.similarity(card['family_name'], burial.family_name)
+        if card['plot'] and burial.plot and card['plot'].strip().lower() == burial.plot.lower():
+            score += 0.15
+        for name in ('date_of_birth', 'date_of_death', 'date_of_burial'):
+            if DuplicateFinder.close_dates(card[name], getattr(burial, name)):
+                score += 0.15
                 break
 
-    def validate_number(window, values, id):
-        value = values[id]
-        for ndx in range(len(value)):
-            if value[ndx] not in '0123456789':
-                value = value[:ndx]
-                window[id].update(value)
-                break
+        return score
+
+    # The likely duplicates of a card as (score, burial), best first
+    def find(sql_session, card, indexed = True):
+        matches = []
+        for burial in DuplicateFinder.candidates_for(sql_session, card, indexed):
+            if burial.id == card.get('id'):
+                continue
+            score = DuplicateFinder.score(card, burial)
+            if score >= DuplicateFinder.threshold:
+                matches.append((score, burial))
+        matches.sort(key = lambda match: match[0], reverse = True)
+
+        return matches[:DuplicateFinder.shown]
+
+    def describe(burial):
+        text = burial.given_names + ' ' + burial.family_name
+        if burial.date_of_death:
+            text += ', died ' + burial.date_of_death
+        elif burial.date_of_burial:
+            text += ', buried ' + burial.date_of_burial
+        if burial.plot:
+            text += ', plot ' + '/'.join(p for p in (burial.plot, burial.plot_row, burial.plot_row_number) if p)
+        if burial.source_document_ref is not None:
+            text += ', ref ' + str(burial.source_document_ref)
+
+        return text
+
+    # The descriptions of the likely duplicates of a card
+    def lookup(sql_session, card, indexed = True):
+        return [DuplicateFinder.describe(burial) for score, burial in DuplicateFinder.find(sql_session, card, indexed)]
+
+    # notify(generation, descriptions) is called from the lookup thread with the results
+    def start(sql_engine, notify):
+        finder_session = Session(sql_engine, expire_on_commit = False)
+        indexed = DuplicateFinder.has_index(finder_session)
+        DuplicateFinder.start_lookups(lambda card: DuplicateFinder.lookup(finder_session, card, indexed), notify, finder_session.close)
+
+    # Run lookup(card) on the lookup thread, for when the cards are somewhere other than a local database
+    def start_lookups(lookup, notify, finished = None):
+        DuplicateFinder.condition = threading.Condition()
+        DuplicateFinder.notify = notify
+        DuplicateFinder.stopping = False
+        DuplicateFinder.thread = threading.Thread(target = DuplicateFinder.run, args = (lookup, finished), name = 'DuplicateFinder', daemon = True)
+        DuplicateFinder.thread.start()
+
+    def request(values):
+        if DuplicateFinder.condition is None:
+            return
+        with DuplicateFinder.condition:
+            DuplicateFinder.card = {name: values['-' + name + '-'] for name in DuplicateFinder.fields}
+            # A card being edited is not a duplicate of itself
+            DuplicateFinder.card['id'] = Burial.editing
+            DuplicateFinder.requested = time.monotonic()
+            DuplicateFinder.generation += 1
+            DuplicateFinder.condition.notify()
+
+    # Drop any lookup not yet reported, its results would be for a card that has gone
+    def cancel():
+        if DuplicateFinder.condition is None:
+            return
+        with DuplicateFinder.condition:
+            DuplicateFinder.card = None
+            DuplicateFinder.generation += 1
 
-    def validate_reference(window, values, id):
-        value = values[id]
-        for ndx in range(len(value)):
-            if value[ndx] not in '0123456789.':
-                value = value[:ndx]
-                window[id].update(value)
+    def stop():
+        if DuplicateFinder.thread is not None:
+            with DuplicateFinder.condition:
+                DuplicateFinder.stopping = True
+                DuplicateFinder.condition.notify()
+            DuplicateFinder.thread.join()
+            DuplicateFinder.thread = None
+
+    def run(lookup, finished):
+        condition = DuplicateFinder.condition
+        while True:
+            with condition:
+                while DuplicateFinder.card is None and not DuplicateFinder.stopping:
+                    condition.wait()
+                # Wait for typing to pause
+                while DuplicateFinder.card is not None and not DuplicateFinder.stopping:
+                    remaining = DuplicateFinder.requested + DuplicateFinder.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    condition.wait(remaining)
+                if DuplicateFinder.stopping:
+                    break
+                card = DuplicateFinder.card
+                generation = DuplicateFinder.generation
+                DuplicateFinder.card = None
+            if card is None:
+                continue
+            try:
+                found = lookup(card)
+            except Exception:
+                # The check is only advice, never let it get in the way of entering cards
+                print('Looking for duplicate cards failed', file = sys.stderr)
+                traceback.print_exc()
+                continue
+            if generation == DuplicateFinder.generation:
+                DuplicateFinder.notify(generation, found)
+        if finished is not None:
+            finished()
+
+# A window for paging through the cards already entered. Only one page is
+# ever fetched: each page starts after (or before) the sort key of the row at
+# the edge of the last one, so the query is an index range scan however deep
+# into the table it is. A filter always uses the index of the chosen order.
+class BurialBrowser:
+    page_size = 20
+    headings = ('Id', 'Ref', 'Given names', 'Family name', 'Died', 'Buried', 'Plot', 'Row', 'Number', 'Page')
+    columns = ('id', 'source_document_ref', 'given_names', 'family_name', 'date_of_death', 'date_of_burial',
+               'plot', 'plot_row', 'plot_row_number', 'page_number')
+    # The columns of each order, ending in id so the key of every row is unique
+    sorts = {'Entered': ('id',),
+             'Name': ('family_name', 'given_names', 'id'),
+             'Plot': ('plot', 'plot_row', 'plot_row_number', 'id'),
+             'Reference': ('source_document_ref', 'id')}
+    finds = {'Entered': 'From card id',
+             'Name': 'Family name starting',
+             'Plot': 'In plot',
+             'Reference': 'From ref'}
+
+    rows = []
+
+    # The lower and upper bounds find puts on the order's first column, either may be None
+    def filter(sort, find):
+        find = (find or '').strip()
+        if find == '':
+            return None, None
+        if sort == 'Name':
+            return Burial.family_name >= find, Burial.family_name < find + '\U0010ffff'
+        if sort == 'Plot':
+            return Burial.plot == find, Burial.plot == find
+        number = BurialStats.as_number(find)
+        if number is None:
+            return None, None
+        if sort == 'Reference':
+            return Burial.source_document_ref >= number, None
+        return Burial.id >= number, None
+
+    # The ranges of rows after (or before) key in the order, nearest first. SQLite
+    # sorts NULL first, so rows with a NULL in a column come before every value.
+    # Each range is the rows sharing the key's first columns and differing at
+    # the next, which SQLite answers as one index range scan
+    def ranges(columns, key, forward):
+        for n in reversed(range(len(columns))):
+            prefix = [column == value for column, value in zip(columns[:n], key[:n])]
+            column, value = columns[n], key[n]
+            if forward:
+                steps = [column != None] if value is None else [column > value]
+            else:
+                steps = [] if value is None else [column < value]
+                if column.nullable and value is not None:
+                    steps.append(column == None)
+            for step in steps:
+                yield and_(*prefix, step)
+
+    # One page of rows in sort order. after or before is the key of the row to
+    # start from, with neither the first page is fetched, or the last when last is set
+    def page(sql_session, sort, find = '', after = None, before = None, last = False, size = None):
+        size = size or BurialBrowser.page_size
+        columns = [Burial.__table__.c[name] for name in BurialBrowser.sorts[sort]]
+        stmt = select(*[Burial.__table__.c[name] for name in BurialBrowser.columns])
+        key = after if after is not None else before
+        forward = before is None and not last
+        # The key already bounds one side, and repeating that bound can lead SQLite to scan the wrong range
+        lower, upper = BurialBrowser.filter(sort, find)
+        for bound in ((lower, upper) if key is None else (upper,) if forward else (lower,)):
+            if bound is not None:
+                stmt = stmt.where(bound)
+        if forward:
+            stmt = stmt.order_by(*columns)
+        else:
+            stmt = stmt.order_by(*[column.desc() for column in columns])
+
+        rows = []
+        with sql_session.begin():
+            if key is None:
+                ranges = [None]
+            elif None not in key and (forward or not any(column.nullable for column in columns)):
+                # A row value comparison is right here, even past rows with NULL in later columns
+                ranges = [tuple_(*columns) > tuple_(*key) if forward else tuple_(*columns) < tuple_(*key)]
+            else:
+                ranges = BurialBrowser.ranges(columns, key, forward)
+            for step in ranges:
+                query = stmt if step is None else stmt.where(step)
+                rows.extend(dict(row) for row in sql_session.execute(query.limit(size - len(rows))).mappings())
+                if len(rows) >= size:
+                    break
+        if not forward:
+            rows.reverse()
+
+        return rows
+
+    def key(sort, row):
+        return tuple(row[name] for name in BurialBrowser.sorts[sort])
+
+    def table_values(rows):
+        return [['' if row[name] is None else row[name] for name in BurialBrowser.columns] for row in rows]
+
+    # Show the browser until it is closed, returning the card chosen for editing if any
+    def show(sql_session):
+        sort = 'Entered'
+        layout = [[sg.Text('Order'), sg.Combo(list(BurialBrowser.sorts), default_value = sort, readonly = True, enable_events = True, key = '-sort-'),
+                   sg.Text(BurialBrowser.finds[sort], size = (20, 1), key = '-find_label-'), sg.Input(size = (20, 1), key = '-find-'), sg.Button('Find')],
+                  [sg.Table(BurialBrowser.table_values([]), headings = list(BurialBrowser.headings), num_rows = BurialBrowser.page_size,
+                            auto_size_columns = False, col_widths = [6, 6, 18, 16, 11, 11, 8, 6, 6, 5], justification = 'left',
+                            select_mode = 'browse', enable_events = True, key = '-cards-', font = (None, 12))],
+                  [sg.Button('First'), sg.Button('Previous'), sg.Button('Next'), sg.Button('Last'), sg.Button('Edit', disabled = True), sg.Button('Close')]]
+        window = sg.Window('Review cards', layout, font = ('', 14), modal = True, finalize = True)
+        window.bind('<Next>', 'Next')
+        window.bind('<Prior>', 'Previous')
+        window.bind('<Escape>', 'Close')
+
+        def load(rows):
+            BurialBrowser.rows = rows
+            window['-cards-'].update(values = BurialBrowser.table_values(rows))
+            window['Edit'].update(disabled = True)
+
+        load(BurialBrowser.page(sql_session, sort))
+        # The filter of the page shown, Next and Previous carry on with it whatever has been typed since
+        find = ''
+        chosen = None
+        while True:
+            event, values = window.read()
+            if event in (sg.WIN_CLOSED, 'Close'):
                 break
+            rows = BurialBrowser.rows
+            if event == '-sort-':
+                sort = values['-sort-']
+                find = values['-find-']
+                window['-find_label-'].update(BurialBrowser.finds[sort])
+                load(BurialBrowser.page(sql_session, sort, find))
+            elif event in ('Find', 'First'):
+                find = values['-find-']
+                load(BurialBrowser.page(sql_session, sort, find))
+            elif event == 'Last':
+                find = values['-find-']
+                load(BurialBrowser.page(sql_session, sort, find, last = True))
+            elif event == 'Next' and rows:
+                page = BurialBrowser.page(sql_session, sort, find, after = BurialBrowser.key(sort, rows[-1]))
+                if page:
+                    load(page)
+            elif event == 'Previous' and rows:
+                page = BurialBrowser.page(sql_session, sort, find, before = BurialBrowser.key(sort, rows[0]))
+                if page:
+                    load(page)
+            elif event == '-cards-':
+                window['Edit'].update(disabled = not values['-cards-'])
+            if event == 'Edit' and values['-cards-']:
+                with sql_session.begin():
+                    chosen = dict(sql_session.execute(select(Burial.__table__).where(Burial.id == rows[values['-cards-'][0]]['id'])).mappings().one())
+                break
+        window.close()
+
+        return chosen
+
+# A save or request the entry server turned down, orig is its reason as
+# IntegrityError.orig would be when saving locally
+class EntryError(Exception):
+    def __init__(self, message, integrity = False):
+        super().__init__(message)
+        self.orig = message
+        self.integrity = integrity
+
+# Connection to entry_server.py, which owns the database when several people
+# enter cards into it at once. Messages are JSON objects one per line; each
+# request carries an id that its reply repeats, and anything without an id is
+# the server pushing the latest counts and defaults after someone saved.
+class EntryClient:
+    DEFAULT_PORT = 8765
+    timeout = 30
+
+    connection = None
+    send_lock = threading.Lock()
+    condition = threading.Condition()
+    replies = {}
+    last_id = 0
+    version = -1
+    closed = False
+    notify = None
+    thread = None
+
+    def parse_address(address):
+        host, sep, port = address.rpartition(':')
+        return host or 'localhost', int(port or EntryClient.DEFAULT_PORT)
+
+    # Connect to the server at host:port and take on its counts and defaults,
+    # returning the name of the source document it is entering
+    def connect(address):
+        EntryClient.connection = socket.create_connection(EntryClient.parse_address(address), timeout = EntryClient.timeout)
+        EntryClient.connection.settimeout(None)
+        EntryClient.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        EntryClient.closed = False
+        EntryClient.version = -1
+        reader = EntryClient.connection.makefile('r', encoding = 'utf-8')
+        EntryClient.thread = threading.Thread(target = EntryClient.run, args = (reader,), name = 'EntryClient', daemon = True)
+        EntryClient.thread.start()
+        reply = EntryClient.request({'op': 'hello'})
+
+        return reply['source_document']
+
+    def close():
+        if EntryClient.connection is not None:
+            try:
+                EntryClient.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            EntryClient.connection.close()
+            EntryClient.thread.join()
+            EntryClient.connection = None
+
+    # Send a request and wait for its reply. Safe to call from any thread
+    def request(message):
+        with EntryClient.condition:
+            EntryClient.last_id += 1
+            id = EntryClient.last_id
+        message = dict(message, id = id)
+        with EntryClient.send_lock:
+            EntryClient.connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        deadline = time.monotonic() + EntryClient.timeout
+        with EntryClient.condition:
+            while id not in EntryClient.replies:
+                remaining = deadline - time.monotonic()
+                if EntryClient.closed:
+                    raise ConnectionError('The connection to the entry server was lost')
+                if remaining <= 0:
+                    raise TimeoutError('The entry server did not reply')
+                EntryClient.condition.wait(remaining)
+            reply = EntryClient.replies.pop(id)
+        if 'state' in reply:
+            EntryClient.apply_state(reply['state'])
+        if reply.get('error') is not None:
+            raise EntryError(reply['error'], reply.get('integrity', False))
+
+        return reply
+
+    # Take on the server's counts and defaults unless newer ones have already arrived
+    def apply_state(state):
+        with EntryClient.condition:
+            if state['version'] <= EntryClient.version:
+                return False
+            EntryClient.version = state['version']
+            for name in ('row_count', 'date_of_birth', 'date_of_death', 'date_of_burial', 'source_document_ref', 'page_number'):
+                setattr(BurialStats, name, state[name])
+            Burial.default_plot = state['default_plot']
+            GraveIndex.capacity = state['capacity']
+
+        return True
+
+    def run(reader):
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if 'id' in message:
+                    with EntryClient.condition:
+                        EntryClient.replies[message['id']] = message
+                        EntryClient.condition.notify_all()
+                elif EntryClient.apply_state(message['state']) and EntryClient.notify is not None:
+                    EntryClient.notify(message['state'])
+        except (OSError, ValueError):
+            pass
+        with EntryClient.condition:
+            EntryClient.closed = True
+            EntryClient.condition.notify_all()
+        # None tells the form the server has gone
+        if EntryClient.notify is not None and EntryClient.connection is not None:
+            EntryClient.notify(None)
 
+    # The next free source document ref, held for this client until it saves or asks again
+    def reserve():
+        return EntryClient.request({'op': 'reserve'})['ref']
+
+    def save(record):
+        return EntryClient.request({'op': 'save', 'record': record})['saved']
+
+    def duplicates(card):
+        return EntryClient.request({'op': 'duplicates', 'card': card})['found']
+
+    def grave(plot, plot_row, plot_row_number):
+        grave = EntryClient.request({'op': 'grave', 'plot': plot, 'plot_row': plot_row, 'plot_row_number': plot_row_number})['grave']
+        if grave is None:
+            return None
+        return tuple(grave)
+
+    def complete(name, prefix):
+        return EntryClient.request({'op': 'complete', 'name': name, 'prefix': prefix})['completion']
+
+def create_db(sql_session):
+    with sql_session.begin():
+        sql_session.execute('''create table burial (
+                               id integer primary key,
+                               given_names varchar(256) not null,
+                               family_name varchar(256) not null,
+                               date_of_birth varchar(32),
+                               date_of_death varchar(32),
+                               date_of_burial varchar(32),
+                               ashes integer,
+                               age_years integer,
+                               age_months integer,
+                               age_days integer,
+                               stillborn integer,
+                               source_document_ref integer unique,
+                               cross_reference integer,
+                               page_number integer,
+                               see_page_number varchar(256),
+                               plot varchar(32),
+                               plot_row varchar(32),
+                               plot_row_number varchar(32),
+                               notes text,
+                               confidence_level integer
+                               )''')
+        sql_session.execute('''create table config (
+                               id integer primary key,
+                               domain varchar(256) not null,
+                               name varchar(256) not null,
+                               value varchar(256)
+                               )''')
+        # A new database starts with everything the migrations would add
+        for version, statements in MIGRATIONS:
+            run_migration(sql_session, statements)
+
+# Every insert, update and delete on burial is recorded in burial_journal by
+# triggers, so cards saved by the form, the entry server or an import are all
+# there. Snapshotter copies it out to the backup directory, where journal.db
+# has the same table, and seq keeps counting up after rows are removed
+JOURNAL_TABLE = '''create table if not exists {schema}burial_journal (
+                   seq integer primary key autoincrement,
+                   changed_at varchar(32) not null default (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+                   change varchar(8) not null,
+                   burial_id integer not null,
+                   given_names varchar(256),
+                   family_name varchar(256),
+                   date_of_birth varchar(32),
+                   date_of_death varchar(32),
+                   date_of_burial varchar(32),
+                   ashes integer,
+                   age_years integer,
+                   age_months integer,
+                   age_days integer,
+                   stillborn integer,
+                   source_document_ref integer,
+                   cross_reference integer,
+                   page_number integer,
+                   see_page_number varchar(256),
+                   plot varchar(32),
+                   plot_row varchar(32),
+                   plot_row_number varchar(32),
+                   notes text,
+                   confidence_level integer
+                   )'''
+
+JOURNAL_COLUMNS = tuple(column.name for column in Burial.__table__.columns if column.name != 'id')
+
+JOURNAL_TRIGGERS = tuple('create trigger if not exists burial_journal_' + change + ' after ' + change + ' on burial begin ' +
+                         'insert into burial_journal (change, burial_id, ' + ', '.join(JOURNAL_COLUMNS) + ') ' +
+                         "values ('" + change + "', new.id, " + ', '.join('new.' + name for name in JOURNAL_COLUMNS) + '); end'
+                         for change in ('insert', 'update')) + (
+                   "create trigger if not exists burial_journal_delete after delete on burial begin "
+                   "insert into burial_journal (change, burial_id) values ('delete', old.id); end",)
+
+# Snapshotter removes journal rows once they are backed up. With backups off,
+# Backup/Minutes 0, nothing would, so the log and the entry server on starting
+# and export_cards.py after a --since-last export remove the rows every named
+# export has already had. Returns the number removed
+def trim_journal(sql_session):
+    Config.invalidate(sql_session)
+    if Config.get_int(sql_session, 'Backup', 'Minutes', Snapshotter.interval // 60) > 0:
+        return 0
+    exported = [Config.get_int(sql_session, domain, name, 0) for domain, name in Config.cache(sql_session) if domain == 'Export']
+    with sql_session.begin():
+        if exported:
+            seq = min(exported)
+        else:
+            seq = sql_session.execute("select seq from sqlite_sequence where name = 'burial_journal'").scalar() or 0
+        return sql_session.execute('delete from burial_journal where seq <= :seq', {'seq': seq}).rowcount
+
+# Schema changes made since the first release, keyed on the version that
+# introduced them. Databases record the version that last touched their schema
+# in the Database/Version config row and are upgraded in place on open.
+# Statements must be safe to repeat as create_db also runs them all, a
+# statement can also be a function taking the session for conditional changes.
+MIGRATIONS = (
+    ('V1.08', ('create index if not exists burial_plot on burial (plot, plot_row, plot_row_number)',
+               'create index if not exists burial_name on burial (family_name, given_names)',
+               'create index if not exists burial_given_names on burial (given_names)',
+               'create index if not exists burial_date_of_birth on burial (date_of_birth)',
+               'create index if not exists burial_date_of_death on burial (date_of_death)',
+               'create index if not exists burial_date_of_burial on burial (date_of_burial)',
+               'create index if not exists burial_page_number on burial (page_number)')),
+    ('V1.09', (lambda sql_session: DuplicateFinder.create_index(sql_session),)),
+    ('V1.10', ('create index if not exists config_domain_name on config (domain, name)',)),
+    ('V1.11', (JOURNAL_TABLE.format(schema = ''),) + JOURNAL_TRIGGERS),
+)
+
+def run_migration(sql_session, statements):
+    for statement in statements:
+        if callable(statement):
+            statement(sql_session)
+        else:
+            sql_session.execute(statement)
+
+# 'V1.07' -> (1, 7), anything unrecognised sorts before every release
+def version_key(version):
+    try:
+        return tuple(int(part) for part in version.lstrip('Vv').split('.'))
+    except (AttributeError, ValueError):
+        return (0,)
+
+# Apply any migrations newer than the database's recorded version, returning the versions applied
+def migrate_db(sql_session):
+    current = Config.get_value(sql_session, 'Database', 'Version')
+    pending = [(version, statements) for version, statements in MIGRATIONS
+               if version_key(version) > version_key(current)]
+    if not pending and version_key(current) >= version_key(VERSION):
+        return []
+
+    with sql_session.begin():
+        for version, statements in pending:
+            run_migration(sql_session, statements)
+    Config.set_value(sql_session, 'Database', 'Version', VERSION)
+    if pending:
+        # Refresh the planner statistics for the new indexes
+        with sql_session.begin():
+            sql_session.execute('analyze')
+
+    return [version for version, statements in pending]
+
+def add_created_by(sql_session):
+    Config.add_value(sql_session, 'Database', 'CreatedBy', 'log.py ' + VERSION)
+    Config.add_value(sql_session, 'Database', 'Version', VERSION)
+
+def get_config_value(sql_session, domain, name):
+    return Config.get_value(sql_session, domain, name)
+
+def get_source_document(sql_session):
+    return get_config_value(sql_session, 'Source', 'DocumentName')
+
+# The database lives next to the executable, or next to this script when not frozen
+def default_db_path():
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-        app_path = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
         exe_path = getattr(sys, 'executable', os.path.abspath(os.path.dirname(__file__)))
-        db_path = os.path.join(os.path.dirname(exe_path), 'cards_log.db')
+        return os.path.join(os.path.dirname(exe_path), 'cards_log.db')
     else:
-        app_path = os.path.abspath(os.path.dirname(__file__))
         exe_path = os.path.abspath(os.path.dirname(__file__))
-        db_path = os.path.join(exe_path, 'cards_log.db')
+        return os.path.join(exe_path, 'cards_log.db')
 
+# Burial and Config are mapped statically instead of being reflected when the
+# database is opened. A fingerprint of the tables' definitions is kept in the
+# config table and only when it changes are the columns compared with the
+# mapped classes
+def schema_fingerprint(sql_session):
+    with sql_session.begin():
+        tables = sql_session.execute("select name, sql from sqlite_master where name in ('burial', 'config') order by name").all()
+
+    return hashlib.sha1(json.dumps([list(t) for t in tables]).encode('utf-8')).hexdigest()
+
+def check_schema(sql_session):
+    fingerprint = schema_fingerprint(sql_session)
+    if fingerprint == Config.get_value(sql_session, 'Database', 'SchemaFingerprint'):
+        return
+
+    problems = []
+    with sql_session.begin():
+        for table in (Burial.__table__, Config.__table__):
+            columns = {}
+            for c in sql_session.execute('pragma table_info(' + table.name + ')'):
+                columns[c[1]] = c[2].upper()
+            for column in table.columns:
+                declared = column.type.compile(dialect = sql_session.bind.dialect).upper()
+                if column.name not in columns:
+                    problems.append(table.name + '.' + column.name + ' is missing')
+                elif columns[column.name] != declared:
+                    problems.append(table.name + '.' + column.name + ' is ' + columns[column.name] + ' not ' + declared)
+    if problems:
+        raise RuntimeError('The database does not match log.py ' + VERSION + ': ' + ', '.join(problems))
+
+    Config.set_value(sql_session, 'Database', 'SchemaFingerprint', fingerprint)
+
+# Open the database, creating it first if it does not exist, and map its tables
+def open_db(db_path, savepoints = False, storage_profile = 'default'):
     sql_engine = create_engine("sqlite+pysqlite:///" + db_path)
+    # Each transaction has a fresh connection, the profile is applied to every one
+    set_pragmas(sql_engine, STORAGE_PROFILES[storage_profile])
+    if savepoints:
+        enable_savepoints(sql_engine)
 
-    sql_session = Session(sql_engine)
+    sql_session = Session(sql_engine, expire_on_commit = False)
 
     must_create_db =  not os.path.exists(db_path)
 
     if must_create_db:
         create_db(sql_session)
 
-    Base.prepare(sql_engine, reflect = True)
+    check_schema(sql_session)
 
     if must_create_db:
         add_created_by(sql_session)
+    else:
+        migrate_db(sql_session)
+        DuplicateFinder.add_missing_index(sql_session)
+
+    return sql_engine, sql_session
+
+# Connection settings for the kind of storage the database is kept on
+STORAGE_PROFILES = {
+    # SQLite's defaults, a rollback journal
+    'default': (),
+    # Write ahead log synced at checkpoints, a 16MB page cache and memory mapped reads.
+    # A power cut can lose the last few commits but never corrupts the database
+    'wal': ('journal_mode = wal', 'synchronous = normal', 'cache_size = -16384',
+            'mmap_size = 268435456', 'temp_store = memory'),
+    # Write ahead log synced on every commit, for removable drives that may be pulled out
+    'wal-safe': ('journal_mode = wal', 'synchronous = full', 'cache_size = -16384'),
+}
+
+def set_pragmas(sql_engine, pragmas):
+    @event.listens_for(sql_engine, 'connect')
+    def do_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute('pragma ' + pragma)
+        cursor.close()
+
+# pysqlite starts transactions lazily and commits on RELEASE of an outer
+# savepoint, let SQLAlchemy emit BEGIN itself so savepoints nest properly
+def enable_savepoints(sql_engine):
+    @event.listens_for(sql_engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(sql_engine, 'begin')
+    def do_begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+if __name__ == '__main__':
+    def create_source_document(sql_session):
+        source_doc = sg.popup_get_text('Enter the source document name')
+        if source_doc is None or source_doc.rstrip() == '':
+            sg.popup('A source document name is required before data can be entered')
+            exit()
+        Config.add_value(sql_session, 'Source', 'DocumentName', source_doc)
+
+        return get_source_document(sql_session)
+
+    def get_plot_default(sql_session):
+        # Get the last entered burial record with a non-null plot and use the plot as a default
+        return Burial.get_last_plot(sql_session)
+
+    def on_diagnostics(values, event):
+        Instrumentation.gui_window()
+
+    def on_save_failed(values, event):
+        # Bring the counts back in line with what was actually committed
+        BurialWriter.flush()
+        BurialStats.load(sql_session)
+        failures = BurialWriter.take_failures()
+        for record, e in failures:
+            Burial.report_save_error(e)
+        if failures:
+            Burial.add_unsaved([record for record, e in failures], values)
+
+    def on_backup_failed(values, event):
+        sg.popup_error(values[event], 'Backing up to ' + Snapshotter.directory + ' failed, cards are still being saved')
+
+    def on_graves_ready(values, event):
+        Burial.show_grave(values)
+
+    def on_duplicates_found(values, event):
+        generation, found = values[event]
+        if generation == DuplicateFinder.generation:
+            Burial.set_state('-duplicates-', values = found)
+
+    def on_save(values, event):
+        if values['-given_names-'].rstrip() == '' or values['-family_name-'].rstrip() == '':
+            sg.popup('Given names or family name cannot be blank')
+        else:
+            Burial.save(values)
+
+    def on_clear(values, event):
+        Burial.next_card(values)
+
+    def on_review(values, event):
+        if EntryClient.connection is not None:
+            sg.popup('Cards can only be reviewed on the computer running the entry server')
+            return
+        record = BurialBrowser.show(sql_session)
+        if record is not None:
+            Burial.edit(record)
+
+    def on_server_state(values, event):
+        if values[event] is None:
+            sg.popup_error('The connection to the entry server was lost, cards cannot be saved until the log is restarted')
+        else:
+            Burial.set_state(Burial.records_entered.key, value = 'Records entered: ' + str(BurialStats.row_count))
+
+    parser = argparse.ArgumentParser(description = 'Church Administration Records Database System - Log ' + VERSION)
+    parser.add_argument('--storage-profile', choices = sorted(STORAGE_PROFILES), default = 'default',
+                        help = 'SQLite settings to use, the wal profiles need the database on a local drive')
+    parser.add_argument('--write-behind', action = 'store_true', help = 'save records on a background thread')
+    parser.add_argument('--instrument', metavar = 'FILE',
+                        help = 'time every event and SQL statement, F12 shows the timings and they are written to FILE on exit')
+    parser.add_argument('--startup-time', metavar = 'FILE',
+                        help = 'append how long each stage of starting up took to FILE as a JSON line, then exit')
+    parser.add_argument('--server', metavar = '[HOST:]PORT',
+                        help = 'enter cards through entry_server.py instead of opening the database')
+    args = parser.parse_args()
+    if args.server and (args.write_behind or args.storage_profile != 'default'):
+        parser.error('--write-behind and --storage-profile cannot be used with --server, the entry server opens the database')
+
+    sql_engine = sql_session = None
+    if args.server:
+        # The server owns the database, the counts and defaults come from it
+        try:
+            source_document = EntryClient.connect(args.server)
+        except OSError as e:
+            load_gui()
+            sg.popup_error(e, 'Could not connect to the entry server at ' + args.server)
+            sys.exit(1)
+        StartupTimer.mark('open_db')
+
+        load_gui()
+        StartupTimer.mark('load_gui')
+    else:
+        db_path = default_db_path()
+
+        try:
+            sql_engine, sql_session = open_db(db_path, savepoints = args.write_behind, storage_profile = args.storage_profile)
+        except RuntimeError as e:
+            load_gui()
+            sg.popup_error(e)
+            sys.exit(1)
+        StartupTimer.mark('open_db')
+
+        if args.instrument:
+            Instrumentation.enable(sql_engine)
 
-    source_document = get_source_document(sql_session)
-    if not source_document:
-        source_document = create_source_document(sql_session)
+        load_gui()
+        StartupTimer.mark('load_gui')
 
-    Burial.set_default_plot(get_plot_default(sql_session))
+        source_document = get_source_document(sql_session)
+        if not source_document:
+            source_document = create_source_document(sql_session)
+
+        Burial.set_default_plot(get_plot_default(sql_session))
+
+        BurialStats.load(sql_session)
+    StartupTimer.mark('load_state')
 
     layout = Burial.gui_layout(source_document)
 
     window = sg.Window('Church Administration Records Database System - Log ' + VERSION, layout, text_justification = 'r', font = ('', 20), finalize = True) #, element_justification = 'c')
+    Burial.bind_events()
+    StartupTimer.mark('window')
 
     Burial.gui_layout_new_record()
+    StartupTimer.mark('ready')
+
+    if args.startup_time:
+        with open(args.startup_time, 'a') as f:
+            f.write(json.dumps(StartupTimer.report()) + '\n')
+        window.close()
+        if sql_session is not None:
+            sql_session.close()
+        EntryClient.close()
+        sys.exit()
+
+    if EntryClient.connection is not None:
+        EntryClient.notify = lambda state: window.write_event_value('-server_state-', state)
+        DuplicateFinder.start_lookups(EntryClient.duplicates, lambda generation, found: window.write_event_value('-duplicates_found-', (generation, found)))
+    else:
+        if args.write_behind:
+            BurialWriter.start(sql_engine, lambda: window.write_event_value('-save_failed-', None))
+
+        DuplicateFinder.start(sql_engine, lambda generation, found: window.write_event_value('-duplicates_found-', (generation, found)))
+
+        # How many coffins make a grave likely full can be set in the config table
+        GraveIndex.start(sql_engine, lambda: window.write_event_value('-graves_ready-', None),
+                         Config.get_int(sql_session, 'Graves', 'Capacity', GraveIndex.capacity))
+
+        # The number of values kept for each completing field can be set in the config table
+        Completer.start(sql_engine, Config.get_int(sql_session, 'Completion', 'Capacity', Completer.capacity))
+
+        # Backed up every Backup/Minutes, 0 turns it off, to Backup/Directory from the config table
+        backup_minutes = Config.get_int(sql_session, 'Backup', 'Minutes', Snapshotter.interval // 60)
+        if backup_minutes > 0:
+            Snapshotter.start(db_path, Config.get_value(sql_session, 'Backup', 'Directory'), backup_minutes * 60,
+                              lambda message: window.write_event_value('-backup_failed-', message))
+        else:
+            trim_journal(sql_session)
+
+    if Instrumentation.enabled:
+        window.bind('<F12>', '-diagnostics-')
+
+    handlers = Burial.event_handlers()
+    handlers.update({'-diagnostics-': on_diagnostics,
+                     '-save_failed-': on_save_failed,
+                     '-duplicates_found-': on_duplicates_found,
+                     '-graves_ready-': on_graves_ready,
+                     '-backup_failed-': on_backup_failed,
+                     '-server_state-': on_server_state,
+                     'Save': on_save,
+                     'Clear': on_clear,
+                     'Review': on_review})
 
     while True:
         event, values = window.read()
         if event == sg.WIN_CLOSED or event == 'Exit':
             break
-        if event in ('-given_names-', '-family_name-'):
-            if len(values['-given_names-']) == 0 or len(values['-family_name-']) == 0:
-                window['Save'].update(disabled = True)
-            else:
-                window['Save'].update(disabled = False)
-        if event in ('-age_years-', '-age_months-', '-age_days-'):
-            validate_age(window, values, event)
-            if any_age_given(window):
-                window['-stillborn-'].update(disabled = True)
-            else:
-                window['-stillborn-'].update(disabled = False)
-        if event == '-stillborn-':
-            if values['-stillborn-']:
-                window['-age_years-'].update(disabled = True)
-                window['#age_years#'].update(text_color = 'grey')
-                window['-age_months-'].update(disabled = True)
-                window['#age_months#'].update(text_color = 'grey')
-                window['-age_days-'].update(disabled = True)
-                window['#age_days#'].update(text_color = 'grey')
-            else:
-                window['-age_years-'].update(disabled = False)
-                window['#age_years#'].update(text_color = 'black')
-                window['-age_months-'].update(disabled = False)
-                window['#age_months#'].update(text_color = 'black')
-                window['-age_days-'].update(disabled = False)
-                window['#age_days#'].update(text_color = 'black')
-        if event == '-source_document_ref-':
-            validate_reference(window, values, '-source_document_ref-')
-        if event == '-cross_reference-':
-            validate_reference(window, values, '-cross_reference-')
-        if event == '-page_number-':
-            validate_number(window, values, '-page_number-')
-        if event == 'Save':
-            if values['-given_names-'].rstrip() == '' or values['-family_name-'].rstrip() == '':
-                sg.popup('Given names or family name cannot be blank')
-            else:
-                Burial.save(values)
-        if event == 'Clear':
-            Burial.gui_layout_new_record()
+        handler = handlers.get(event)
+        if handler is None:
+            continue
+        if Instrumentation.enabled:
+            event_started = time.perf_counter()
+            handler(values, event)
+            Instrumentation.record('event ' + str(event), time.perf_counter() - event_started)
+        else:
+            handler(values, event)
+
+    DuplicateFinder.stop()
+
+    if BurialWriter.thread is not None:
+        BurialWriter.stop()
+        for record, e in BurialWriter.take_failures():
+            Burial.report_save_error(e)
+            Burial.unsaved.append(record)
+    for record in Burial.unsaved:
+        sg.popup('The card for ' + record['given_names'] + ' ' + record['family_name'] + ' was not saved and must be entered again')
+
+    Snapshotter.stop()
+
+    if args.instrument:
+        Instrumentation.dump(args.instrument)
 
-    sql_session.close()
+    if sql_session is not None:
+        sql_session.close()
+    EntryClient.close()
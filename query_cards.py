@@ -0,0 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+import argparse
+import csv
+import fnmatch
+import json
+import multiprocessing
+import os
+import pathlib
+import queue
+import sqlite3
+import sys
+import time
+from log import get_source_document
+
+FORMATS = ('csv', 'jsonl')
+
+# Every database is opened read only, and a locked one is given up on after this many seconds
+BUSY_TIMEOUT = 1.0
+
+# Workers hand their rows over batch_size at a time and wait once this many batches are waiting to be written
+QUEUED_BATCHES = 16
+
+# Each parish or batch of cards has its own cards_log.db, so look for them below each root.
+# A root that is a file is queried as it is
+def find_databases(roots, pattern = 'cards_log.db'):
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if fnmatch.fnmatch(file_name, pattern):
+                    yield os.path.join(dir_path, file_name)
+
+# Run query against one database in a worker process, putting the rows on
+# results in batches as they are fetched, then a last item with the error if
+# there was one and the time taken. Each item is tagged with the database's
+# index. The database is opened with a read only URI rather than through
+# open_db so nothing is created or migrated, and anything that goes wrong with
+# the database is reported rather than raised so one bad file does not stop the rest
+def query_db(index, db_path, query, params, results, cancelled, batch_size = 1000):
+    started = time.perf_counter()
+    url = 'sqlite+pysqlite:///' + pathlib.Path(db_path).absolute().as_uri() + '?mode=ro&uri=true'
+    sql_engine = create_engine(url, connect_args = {'timeout': BUSY_TIMEOUT})
+    sql_session = Session(sql_engine)
+    source_document = None
+    error = None
+    try:
+        source_document = get_source_document(sql_session)
+        with sql_session.begin():
+            result = sql_session.execute(text(query), params)
+            columns = list(result.keys())
+            # The first batch is sent even when empty so the columns are known
+            rows = [tuple(row) for row in result.fetchmany(batch_size)]
+            put_result(results, cancelled, (index, (db_path, source_document, columns, rows, None, None)))
+            while rows:
+                rows = [tuple(row) for row in result.fetchmany(batch_size)]
+                if rows:
+                    put_result(results, cancelled, (index, (db_path, source_document, columns, rows, None, None)))
+    except (DBAPIError, sqlite3.Error) as e:
+        error = str(getattr(e, 'orig', e))
+    finally:
+        sql_session.close()
+        sql_engine.dispose()
+    put_result(results, cancelled, (index, (db_path, source_document, None, None, error, time.perf_counter() - started)))
+
+# Wait for room on results, giving up once the query is no longer wanted
+def put_result(results, cancelled, item):
+    while True:
+        try:
+            results.put(item, timeout = 0.5)
+            return
+        except queue.Full:
+            if cancelled.is_set():
+                raise RuntimeError('The query was stopped')
+
+# Run query against every database in a pool of processes, yielding batches of
+# rows as (db_path, source_document, columns, rows, None, None) as soon as any
+# worker has fetched them, so neither the merged output nor memory waits on the
+# largest file. Each database ends with (db_path, source_document, None, None,
+# error, elapsed), including one whose worker died
+def federated_query(db_paths, query, params = None, workers = None, batch_size = 1000):
+    started = time.perf_counter()
+    with multiprocessing.Manager() as manager:
+        results = manager.Queue(QUEUED_BATCHES)
+        cancelled = manager.Event()
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(query_db, index, db_path, query, params or {}, results, cancelled, batch_size)
+                       for index, db_path in enumerate(db_paths)]
+            finished = set()
+            try:
+                while len(finished) < len(futures):
+                    try:
+                        index, item = results.get(timeout = 0.1)
+                    except queue.Empty:
+                        # A worker that died or raised never puts its last item
+                        for index, future in enumerate(futures):
+                            if index not in finished and future.done() and future.exception() is not None:
+                                finished.add(index)
+                                yield (db_paths[index], None, None, None, 'the query failed: %s' % future.exception(),
+                                       time.perf_counter() - started)
+                        continue
+                    if item[3] is None:
+                        finished.add(index)
+                    yield item
+            finally:
+                # Workers still running stop at their next batch if the results are not all read
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+
+# progress is called as each database finishes with the number of its rows written
+def write_csv(file, results, progress):
+    writer = None
+    columns = None
+    counts = {}
+    mismatched = set()
+    for db_path, source_document, result_columns, rows, error, elapsed in results:
+        if rows is None:
+            if not error and db_path in mismatched:
+                error = 'the columns differ from the other databases'
+            progress(db_path, source_document, counts.pop(db_path, 0), error, elapsed)
+            continue
+        # The header comes from the first database to answer, the rest must match it
+        if writer is None:
+            columns = result_columns
+            writer = csv.writer(file)
+            writer.writerow(['source_document', 'database'] + columns)
+        elif result_columns != columns:
+            mismatched.add(db_path)
+            continue
+        writer.writerows([source_document, db_path] + list(row) for row in rows)
+        counts[db_path] = counts.get(db_path, 0) + len(rows)
+        yield len(rows)
+
+def write_jsonl(file, results, progress):
+    counts = {}
+    for db_path, source_document, columns, rows, error, elapsed in results:
+        if rows is None:
+            progress(db_path, source_document, counts.pop(db_path, 0), error, elapsed)
+            continue
+        tag = {'source_document': source_document, 'database': db_path}
+        file.write(''.join(json.dumps(dict(tag, **dict(zip(columns, row)))) + '\n' for row in rows))
+        counts[db_path] = counts.get(db_path, 0) + len(rows)
+        yield len(rows)
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+def print_timing(db_path, source_document, rows, error, elapsed):
+    if error and rows:
+        print('%8.3fs %8d  %s: stopped, %s' % (elapsed, rows, db_path, error), file = sys.stderr)
+    elif error:
+        print('%8.3fs  skipped  %s: %s' % (elapsed, db_path, error), file = sys.stderr)
+    else:
+        print('%8.3fs %8d  %s (%s)' % (elapsed, rows, db_path, source_document), file = sys.stderr)
+
+def parse_param(param):
+    name, sep, value = param.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE')
+    return name, value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run a read only query against many card databases and merge the results')
+    parser.add_argument('query', help = 'SQL to run against each database, eg "select * from burial where family_name = :name"')
+    parser.add_argument('roots', nargs = '+', help = 'databases, or directories to search for them')
+    parser.add_argument('--pattern', default = 'cards_log.db', help = 'file names to look for in directories (default: %(default)s)')
+    parser.add_argument('--param', type = parse_param, action = 'append', default = [], metavar = 'NAME=VALUE',
+                        help = 'value for a :NAME parameter in the query, may be repeated')
+    parser.add_argument('--format', choices = FORMATS, default = 'csv', help = 'output format (default: %(default)s)')
+    parser.add_argument('--output', help = 'file to write the results to (default: standard output)')
+    parser.add_argument('--workers', type = int, help = 'processes to query with (default: one per CPU)')
+    parser.add_argument('--batch-size', type = int, default = 1000, help = 'rows handed from a worker at a time (default: %(default)s)')
+    parser.add_argument('--quiet', action = 'store_true', help = 'only report the totals')
+    args = parser.parse_args()
+
+    db_paths = list(find_databases(args.roots, args.pattern))
+    if not db_paths:
+        sys.exit('No databases named %s were found' % args.pattern)
+
+    skipped = []
+    def progress(db_path, source_document, rows, error, elapsed):
+        if error:
+            skipped.append(db_path)
+        if error or not args.quiet:
+            print_timing(db_path, source_document, rows, error, elapsed)
+
+    started = time.perf_counter()
+    file = open(args.output, 'w', encoding = 'utf-8', newline = '') if args.output else sys.stdout
+    try:
+        results = federated_query(db_paths, args.query, dict(args.param), args.workers, args.batch_size)
+        rows = sum(WRITERS[args.format](file, results, progress))
+    finally:
+        if args.output:
+            file.close()
+
+    print('Queried %d databases (%d skipped) in %.2fs, %d rows' %
+          (len(db_paths) - len(skipped), len(skipped), time.perf_counter() - started, rows), file = sys.stderr)
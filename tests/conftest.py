@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log
+
+# A card with every field, the tests change what they need
+def make_record(**values):
+    record = {field.name: None for field in log.FIELDS}
+    record.update(given_names = 'John', family_name = 'Smith', confidence_level = 3)
+    record.update(values)
+    return record
+
+# A new database for each test, also set as the one the form uses
+@pytest.fixture
+def db(tmp_path):
+    db_path = str(tmp_path / 'cards_log.db')
+    sql_engine, sql_session = log.open_db(db_path)
+    log.sql_session = sql_session
+    log.BurialStats.load(sql_session)
+    yield db_path, sql_engine, sql_session
+    sql_session.close()
+    sql_engine.dispose()
@@ -0,0 +1,93 @@
+import sqlite3
+import backup_cards
+from log import Burial, Config, Snapshotter, trim_journal
+from conftest import make_record
+
+def name_search(db_path, text):
+    connection = sqlite3.connect(db_path)
+    try:
+        connection.execute("insert into burial_name_search (burial_name_search) values ('integrity-check')")
+        return sorted(row[0] for row in connection.execute('select rowid from burial_name_search where burial_name_search match ?',
+                                                           ('"' + text + '"',)))
+    finally:
+        connection.close()
+
+def test_restore_replays_edits_through_the_name_search(db, tmp_path):
+    db_path, sql_engine, sql_session = db
+    directory = str(tmp_path / 'backups')
+    Burial.save_record(sql_session, make_record(given_names = 'John', source_document_ref = 1))
+    Burial.save_record(sql_session, make_record(given_names = 'Mary', source_document_ref = 2))
+    Snapshotter.snapshot(db_path, directory)
+
+    Burial.update_record(sql_session, 1, make_record(given_names = 'Jonathan', source_document_ref = 1))
+    Burial.save_record(sql_session, make_record(given_names = 'John', source_document_ref = 3))
+    with sql_session.begin():
+        sql_session.execute('delete from burial where id = 2')
+    base, copied = Snapshotter.snapshot(db_path, directory)
+    assert (base, copied) == (None, 3)
+
+    journal = sqlite3.connect(str(tmp_path / 'backups' / 'journal.db'))
+    before_edit = journal.execute("select changed_at from burial_journal where change = 'update'").fetchone()[0]
+    journal.close()
+
+    restored = str(tmp_path / 'restored.db')
+    assert backup_cards.restore(directory, restored, '9999-12-31 00:00:00.000') == (2, 3)
+    assert name_search(restored, 'John') == [3]
+    assert name_search(restored, 'Jonathan') == [1]
+    connection = sqlite3.connect(restored)
+    assert connection.execute('select id, given_names from burial order by id').fetchall() == [(1, 'Jonathan'), (3, 'John')]
+    assert [row[0] for row in connection.execute('select seq from burial_journal order by seq')] == [1, 2, 3, 4, 5]
+    connection.close()
+
+    # Up to just before the edit the card still has its first name
+    earlier = str(tmp_path / 'earlier.db')
+    assert backup_cards.restore(directory, earlier, before_edit[:-1] + chr(ord(before_edit[-1]) - 1)) == (2, 0)
+    assert name_search(earlier, 'John') == [1]
+    assert name_search(earlier, 'Mary') == [2]
+
+def test_journal_is_trimmed_while_backups_are_off(db, tmp_path):
+    db_path, sql_engine, sql_session = db
+    directory = str(tmp_path / 'backups')
+    Burial.save_record(sql_session, make_record(given_names = 'John', source_document_ref = 1))
+    Snapshotter.snapshot(db_path, directory)
+
+    Config.set_value(sql_session, 'Backup', 'Minutes', '0')
+    Burial.save_record(sql_session, make_record(given_names = 'Mary', source_document_ref = 2))
+    Config.set_value(sql_session, 'Export', 'partner', '1')
+    Burial.save_record(sql_session, make_record(given_names = 'Anne', source_document_ref = 3))
+    # Only what the partner export has already had goes
+    assert trim_journal(sql_session) == 0
+    Config.set_value(sql_session, 'Export', 'partner', '3')
+    assert trim_journal(sql_session) == 2
+    Config.set_value(sql_session, 'Export', 'partner', '0')
+
+    # Backups turned on again start with a full copy, as journal.db never had Mary
+    Config.set_value(sql_session, 'Backup', 'Minutes', '10')
+    assert trim_journal(sql_session) == 0
+    base, copied = Snapshotter.snapshot(db_path, directory)
+    assert base == 3
+    restored = str(tmp_path / 'restored.db')
+    backup_cards.restore(directory, restored, '9999-12-31 00:00:00.000')
+    connection = sqlite3.connect(restored)
+    assert [row[0] for row in connection.execute('select given_names from burial order by id')] == ['John', 'Mary', 'Anne']
+    connection.close()
+
+# As when the clocks go back an hour, a later change can have an earlier time
+def test_restore_replays_every_change_up_to_the_time(db, tmp_path):
+    db_path, sql_engine, sql_session = db
+    directory = str(tmp_path / 'backups')
+    Snapshotter.snapshot(db_path, directory)
+    for ref, name in enumerate(('John', 'Mary', 'Anne'), 1):
+        Burial.save_record(sql_session, make_record(given_names = name, source_document_ref = ref))
+    Snapshotter.snapshot(db_path, directory)
+    journal = sqlite3.connect(str(tmp_path / 'backups' / 'journal.db'))
+    for seq, changed_at in ((1, '2024-10-27 01:30:00.000'), (2, '2024-10-27 01:50:00.000'), (3, '2024-10-27 01:10:00.000')):
+        journal.execute('update burial_journal set changed_at = ? where seq = ?', (changed_at, seq))
+    journal.commit()
+    journal.close()
+
+    restored = str(tmp_path / 'restored.db')
+    assert backup_cards.restore(directory, restored, '2024-10-27 01:40:00.000') == (0, 3)
+    connection = sqlite3.connect(restored)
+    assert [row[0] for row in connection.execute('select given_names from burial order by id')] == ['John', 'Mary', 'Anne']
+    connection.close()
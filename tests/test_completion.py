@@ -0,0 +1,85 @@
+import pytest
+from log import FIELDS_BY_NAME, Burial, Completer
+from conftest import make_record
+
+# Stands in for a Tk entry, a character typed replaces the selection like it does in Tk
+class Entry:
+    def __init__(self, key):
+        self.key = key
+        self.value = ''
+        self.selected = None
+        self.Widget = self
+
+    def update(self, value = None, **state):
+        if value is not None:
+            self.value = value
+            self.selected = None
+
+    def select_range(self, start, end):
+        self.selected = start
+
+    def icursor(self, position):
+        pass
+
+# Each key press is sent on like PySimpleGUI does with enable_events, whether it changed the field or not
+class Form:
+    def __init__(self, name):
+        self.name = name
+        self.key = FIELDS_BY_NAME[name].key
+        self.entry = Entry(self.key)
+        Burial.elements[self.key] = self.entry
+        Burial.reset_completion({})
+
+    def press(self, character = None, backspace = False):
+        entry = self.entry
+        if backspace or character is not None:
+            value = entry.value if entry.selected is None else entry.value[:entry.selected]
+            if backspace and entry.selected is None:
+                value = value[:-1]
+            entry.value = value + (character or '')
+            entry.selected = None
+        Burial.complete({self.key: entry.value}, self.key, self.name)
+
+    def type(self, text):
+        for character in text:
+            self.press(character)
+
+@pytest.fixture
+def completer():
+    Completer.counts = {}
+    Completer.tries = {name: [{}, [], None] for name in Completer.fields}
+    for plot, given_names, count in (('A1', 'John William', 3), ('A10', 'John', 1)):
+        for n in range(count):
+            Completer.add(make_record(plot = plot, given_names = given_names))
+    yield
+    Completer.counts = {}
+    Completer.tries = {}
+
+def test_tab_accepts_the_completion(completer):
+    form = Form('plot')
+    form.type('a')
+    assert form.entry.value == 'A1'
+    form.press()                        # Tab
+    assert form.entry.value == 'A1'
+    form.press()                        # and the key press landing in the next field
+    assert form.entry.value == 'A1'
+
+def test_shift_does_not_extend_the_completion(completer):
+    form = Form('given_names')
+    form.type('John W')
+    assert form.entry.value == 'John William'
+    assert form.entry.selected == len('John W')
+    form.press()                        # Shift
+    form.press('H')
+    assert form.entry.value == 'John WH'
+
+def test_deleting_does_not_complete(completer):
+    form = Form('plot')
+    form.type('A')
+    assert form.entry.value == 'A1'
+    form.press(backspace = True)
+    assert form.entry.value == 'A'
+    form.press()                        # Left arrow
+    assert form.entry.value == 'A'
+    form.type('1')
+    assert form.entry.value == 'A10'
@@ -0,0 +1,43 @@
+import queue
+import sqlite3
+from log import FIELDS, Burial, DuplicateFinder, open_db
+from conftest import make_record
+
+def form_values(**values):
+    form = {field.key: '' for field in FIELDS}
+    form.update({'-' + name + '-': value for name, value in values.items()})
+    return form
+
+def test_lookups_keep_working_after_the_first(db, monkeypatch):
+    db_path, sql_engine, sql_session = db
+    monkeypatch.setattr(DuplicateFinder, 'delay', 0)
+    Burial.save_record(sql_session, make_record(given_names = 'John', family_name = 'Smith', date_of_death = '1901-02-03'))
+    Burial.save_record(sql_session, make_record(given_names = 'Mary', family_name = 'Jones', date_of_death = '1902-03-04'))
+    found = queue.Queue()
+    DuplicateFinder.start(sql_engine, lambda generation, descriptions: found.put(descriptions))
+    try:
+        DuplicateFinder.request(form_values(given_names = 'John', family_name = 'Smith'))
+        assert 'John Smith' in found.get(timeout = 5)[0]
+        DuplicateFinder.request(form_values(given_names = 'Mary', family_name = 'Jones'))
+        assert 'Mary Jones' in found.get(timeout = 5)[0]
+        DuplicateFinder.request(form_values(given_names = 'John', family_name = 'Smith'))
+        assert 'John Smith' in found.get(timeout = 5)[0]
+    finally:
+        DuplicateFinder.stop()
+
+def test_name_search_missing_from_a_migration_is_added_on_open(db):
+    db_path, sql_engine, sql_session = db
+    sql_session.close()
+    sql_engine.dispose()
+    connection = sqlite3.connect(db_path)
+    for trigger in ('insert', 'delete', 'update'):
+        connection.execute('drop trigger burial_name_search_' + trigger)
+    connection.execute('drop table burial_name_search')
+    connection.close()
+
+    sql_engine, sql_session = open_db(db_path)
+    try:
+        assert DuplicateFinder.has_index(sql_session)
+    finally:
+        sql_session.close()
+        sql_engine.dispose()
@@ -0,0 +1,40 @@
+import pytest
+from entry_server import EntryServer
+from log import Burial, Config, EntryClient, EntryError, GraveIndex
+from conftest import make_record
+
+@pytest.fixture
+def server(db):
+    db_path, sql_engine, sql_session = db
+    Config.add_value(sql_session, 'Source', 'DocumentName', 'St Mary')
+    host, port = EntryServer.start(sql_engine, sql_session, '127.0.0.1', 0)
+    GraveIndex.thread.join()
+    try:
+        yield sql_session, '%s:%d' % (host, port)
+    finally:
+        EntryClient.close()
+        EntryServer.stop()
+
+def test_save_edit_and_look_up_through_the_server(server):
+    sql_session, address = server
+    assert EntryClient.connect(address) == 'St Mary'
+
+    ref = EntryClient.reserve()
+    assert ref == 1
+    id = EntryClient.save(make_record(given_names = 'John', family_name = 'Smith', plot = 'A', plot_row = '1', plot_row_number = '2',
+                                      source_document_ref = ref))
+    assert EntryClient.reserve() == 2
+    found = EntryClient.duplicates({'given_names': 'John', 'family_name': 'Smith', 'date_of_birth': '', 'date_of_death': '',
+                                    'date_of_burial': '', 'plot': 'A', 'id': None})
+    assert len(found) == 1 and 'John Smith' in found[0]
+
+    # Cards are edited on the computer running the server, the forms see the change
+    Burial.update_record(sql_session, id, make_record(given_names = 'Jonathan', family_name = 'Smith', plot = 'A', plot_row = '1',
+                                                      plot_row_number = '2', source_document_ref = ref))
+    described, coffins, plot_counts = EntryClient.grave('A', '1', '2')
+    assert len(described) == 1 and 'Jonathan Smith' in described[0]
+    assert (coffins, tuple(plot_counts)) == (1, (1, 1))
+
+    with pytest.raises(EntryError) as e:
+        EntryClient.save(make_record(given_names = 'Mary', source_document_ref = ref))
+    assert e.value.integrity
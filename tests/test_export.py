@@ -0,0 +1,48 @@
+import pytest
+import export_cards
+from log import Burial, Config, Snapshotter
+from conftest import make_record
+
+def export_since(sql_session, path, db_path, name):
+    after_seq = Config.get_int(sql_session, 'Export', name, 0)
+    ids, last_seq = export_cards.changed_ids(sql_session, after_seq, Snapshotter.default_directory(db_path))
+    rows, last_id, elapsed = export_cards.export_cards(sql_session, path, 'jsonl', ids = ids if after_seq else None)
+    Config.set_value(sql_session, 'Export', name, str(last_seq))
+    with open(path) as f:
+        return f.read()
+
+def test_since_last_picks_up_edited_cards(db, tmp_path):
+    db_path, sql_engine, sql_session = db
+    Burial.save_record(sql_session, make_record(given_names = 'John', source_document_ref = 1))
+    Burial.save_record(sql_session, make_record(given_names = 'Mary', source_document_ref = 2))
+    first = export_since(sql_session, str(tmp_path / 'first.jsonl'), db_path, 'partner')
+    assert first.count('\n') == 2
+
+    # The edit is moved out to the backup's journal.db before the next export
+    Burial.update_record(sql_session, 1, make_record(given_names = 'Jonathan', source_document_ref = 1))
+    Snapshotter.snapshot(db_path, Snapshotter.default_directory(db_path))
+    Burial.save_record(sql_session, make_record(given_names = 'Anne', source_document_ref = 3))
+    second = export_since(sql_session, str(tmp_path / 'second.jsonl'), db_path, 'partner')
+    assert second.count('\n') == 2
+    assert 'Jonathan' in second and 'Anne' in second and 'Mary' not in second
+
+    assert export_since(sql_session, str(tmp_path / 'third.jsonl'), db_path, 'partner') == ''
+
+def test_parquet_keeps_references_with_dots(db, tmp_path):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    db_path, sql_engine, sql_session = db
+    Burial.save_record(sql_session, make_record(source_document_ref = '12.5', cross_reference = '3.1', page_number = '7'))
+    Burial.save_record(sql_session, make_record(source_document_ref = '13', cross_reference = '1.2.3'))
+    path = str(tmp_path / 'cards.parquet')
+    export_cards.export_cards(sql_session, path, 'parquet')
+    table = pyarrow_parquet.read_table(path).to_pydict()
+    assert table['source_document_ref'] == ['12.5', '13']
+    assert table['cross_reference'] == ['3.1', '1.2.3']
+    assert table['page_number'] == [7, None]
+
+def test_parquet_will_not_drop_a_page_number(db, tmp_path):
+    pytest.importorskip('pyarrow')
+    db_path, sql_engine, sql_session = db
+    Burial.save_record(sql_session, make_record(page_number = '7a'))
+    with pytest.raises(ValueError, match = 'page_number'):
+        export_cards.export_cards(sql_session, str(tmp_path / 'cards.parquet'), 'parquet')
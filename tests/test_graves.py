@@ -0,0 +1,54 @@
+import threading
+from log import Burial, GraveIndex
+from conftest import make_record
+
+# Cards saved and edited while the index is being built are held back and folded in
+# once it is, whether or not the scan already saw them
+def test_cards_changed_during_the_build_are_counted_once(db):
+    db_path, sql_engine, sql_session = db
+    Burial.save_record(sql_session, make_record(plot = 'A', plot_row = '1', plot_row_number = '1', source_document_ref = 1))
+    GraveIndex.pending = []
+    GraveIndex.graves = None
+    Burial.save_record(sql_session, make_record(plot = 'A', source_document_ref = 2))
+    Burial.save_record(sql_session, make_record(plot = 'A', plot_row = '1', plot_row_number = '1', ashes = True, source_document_ref = 3))
+    Burial.update_record(sql_session, 1, make_record(plot = 'B', plot_row = '2', plot_row_number = '2', source_document_ref = 1))
+    Burial.update_record(sql_session, 2, make_record(plot = 'B', source_document_ref = 2))
+    assert len(GraveIndex.pending) == 4
+
+    GraveIndex.build(sql_engine)
+
+    assert GraveIndex.pending is None
+    assert GraveIndex.plot_counts('A') == (1, 1)
+    assert GraveIndex.plot_counts('B') == (2, 1)
+    assert GraveIndex.occupants('A', '1', '1') == ([3], 0)
+    assert GraveIndex.occupants('B', '2', '2') == ([1], 1)
+
+    Burial.save_record(sql_session, make_record(plot = 'B', plot_row = '2', plot_row_number = '2', source_document_ref = 4))
+    assert GraveIndex.occupants('B', '2', '2') == ([1, 4], 2)
+    assert GraveIndex.plot_counts('B') == (3, 1)
+
+# The build reads a few cards at a time while cards go on being saved, edited and deleted
+def test_the_build_ends_up_as_a_fresh_build_would(db, monkeypatch):
+    db_path, sql_engine, sql_session = db
+    monkeypatch.setattr(GraveIndex, 'chunk', 3)
+    for ref in range(1, 61):
+        Burial.save_record(sql_session, make_record(plot = 'ABC'[ref % 3], plot_row = str(ref % 4), plot_row_number = str(ref % 5),
+                                                    ashes = ref % 7 == 0, source_document_ref = ref))
+    GraveIndex.pending = []
+    GraveIndex.graves = None
+    building = threading.Thread(target = GraveIndex.build, args = (sql_engine,))
+    building.start()
+    for id in range(1, 61, 2):
+        Burial.update_record(sql_session, id, make_record(plot = 'D', plot_row = str(id % 2), plot_row_number = '1', source_document_ref = id))
+    for ref in range(61, 71):
+        Burial.save_record(sql_session, make_record(plot = 'A', plot_row = '1', plot_row_number = '1', source_document_ref = ref))
+    building.join()
+    built = index_state()
+
+    GraveIndex.pending = []
+    GraveIndex.build(sql_engine)
+    assert built == index_state()
+
+# Cards changed during a build are added after the ones read, so only the order of each grave's ids can differ
+def index_state():
+    return {key: sorted(ids) for key, ids in GraveIndex.graves.items()}, GraveIndex.coffins, GraveIndex.plots
@@ -0,0 +1,18 @@
+import io
+import import_cards
+
+def test_confidence_levels_are_matched_whatever_the_case(db):
+    db_path, sql_engine, sql_session = db
+    file = io.StringIO('given_names,family_name,source_document_ref,confidence_level\n'
+                       'John,Smith,1,high\n'
+                       'Mary,Smith,2, LOW \n'
+                       'Anne,Smith,3,Medium\n'
+                       'Jane,Smith,4,\n'
+                       'Ruth,Smith,5,hihg\n')
+    rows, inserted, rejects, elapsed = import_cards.import_cards(sql_session, file)
+    assert (rows, inserted) == (5, 4)
+    assert [line for line, error in rejects] == [6]
+    assert 'hihg' in rejects[0][1]
+    with sql_session.begin():
+        levels = sql_session.execute('select given_names, confidence_level from burial order by id').fetchall()
+    assert levels == [('John', 3), ('Mary', 1), ('Anne', 2), ('Jane', 0)]
@@ -0,0 +1,22 @@
+import pytest
+import sqlalchemy
+from log import Instrumentation
+
+def test_failed_statements_are_not_left_timing(db, monkeypatch):
+    db_path, sql_engine, sql_session = db
+    monkeypatch.setattr(Instrumentation, 'samples', {})
+    Instrumentation.enable(sql_engine)
+    try:
+        with sql_engine.connect() as connection:
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                connection.exec_driver_sql('select * from no_such_table')
+            assert connection.info['statement_started'] == []
+            connection.exec_driver_sql('select 1')
+            assert connection.info['statement_started'] == []
+        assert [name for name in Instrumentation.samples if 'no_such_table' in name] == []
+        assert 'sql select 1' in Instrumentation.samples
+    finally:
+        sqlalchemy.event.remove(sql_engine, 'before_cursor_execute', Instrumentation.before_cursor_execute)
+        sqlalchemy.event.remove(sql_engine, 'after_cursor_execute', Instrumentation.after_cursor_execute)
+        sqlalchemy.event.remove(sql_engine, 'handle_error', Instrumentation.handle_error)
+        Instrumentation.enabled = False
@@ -0,0 +1,35 @@
+import io
+import os
+import query_cards
+from log import Burial, Config
+from conftest import make_record
+
+def test_rows_are_streamed_from_every_database(db, tmp_path):
+    db_path, sql_engine, sql_session = db
+    Config.add_value(sql_session, 'Source', 'DocumentName', 'St Mary')
+    for ref in range(1, 8):
+        Burial.save_record(sql_session, make_record(source_document_ref = ref))
+    broken = str(tmp_path / 'broken' / 'cards_log.db')
+    os.makedirs(os.path.dirname(broken))
+    with open(broken, 'w') as f:
+        f.write('not a database')
+
+    finished = {}
+    def progress(db_path, source_document, rows, error, elapsed):
+        finished[db_path] = (source_document, rows, error)
+    results = query_cards.federated_query([db_path, broken], 'select id from burial order by id', workers = 2, batch_size = 2)
+    output = io.StringIO()
+    # Seven rows come in four batches, the first is also the header's
+    assert list(query_cards.write_csv(output, results, progress)) == [2, 2, 2, 1]
+
+    assert output.getvalue().splitlines() == ['source_document,database,id'] + ['St Mary,%s,%d' % (db_path, id) for id in range(1, 8)]
+    assert finished[db_path] == ('St Mary', 7, None)
+    assert finished[broken][1] == 0 and finished[broken][2]
+
+def test_stopping_early_stops_the_workers(db):
+    db_path, sql_engine, sql_session = db
+    for ref in range(1, 101):
+        Burial.save_record(sql_session, make_record(source_document_ref = ref))
+    results = query_cards.federated_query([db_path] * 3, 'select id from burial', workers = 3, batch_size = 1)
+    assert next(results)[3] == [(1,)]
+    results.close()
@@ -0,0 +1,18 @@
+import queue
+from log import BurialWriter
+from conftest import make_record
+
+# Like the entry server replying to a client that has already gone
+def test_a_failing_callback_does_not_stop_the_writer(db, capsys):
+    db_path, sql_engine, sql_session = db
+    saved = queue.Queue()
+    def gone(id, e):
+        raise ValueError('I/O operation on closed file.')
+    BurialWriter.start(sql_engine)
+    try:
+        BurialWriter.put(make_record(source_document_ref = 1), gone)
+        BurialWriter.put(make_record(source_document_ref = 2), lambda id, e: saved.put((id, e)))
+        assert saved.get(timeout = 5) == (2, None)
+    finally:
+        BurialWriter.stop()
+    assert 'Reporting a saved card failed' in capsys.readouterr().err